@@ -0,0 +1,166 @@
+#===============================================================================
+#
+#  Flatmap server
+#
+#  Copyright (c) 2019-2025  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+"""
+Files derived from a map's files, such as ``pathways.sqlite`` and ``hierarchy.json``,
+are made when first needed and then kept in the map's directory.
+
+Each is made by only one process at a time, under an exclusive lock on a single
+file in the map's directory, and is written to a temporary file that is then
+renamed, so that a partially written file is never read. A stamp file records the version of the code that made the
+file and the state of the files it was derived from, so that an out-of-date
+file is remade.
+"""
+
+#===============================================================================
+
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+from pathlib import Path
+import threading
+from typing import Any, Optional
+
+#===============================================================================
+
+# Locked while making any of the artifacts in a directory
+ARTIFACT_LOCK_FILE = '.artifacts.lock'
+
+ARTIFACT_STAMP_SUFFIX = '.stamp'
+
+#===============================================================================
+
+def map_files_source(map_path: Path, filenames: tuple[str, ...]) -> str:
+#=======================================================================
+    """
+    Identifies the state of the files in a map's directory that an artifact
+    is derived from.
+    """
+    parts = []
+    for filename in filenames:
+        try:
+            stat = (map_path / filename).stat()
+            parts.append(f'{filename}:{stat.st_mtime_ns}:{stat.st_size}')
+        except OSError:
+            pass
+    return ','.join(parts)
+
+def write_atomically(path: Path, data: bytes, modified_ns: Optional[int]=None):
+#==============================================================================
+    """
+    Write a file so that readers see either its old or its new content,
+    optionally giving the file a modification time.
+    """
+    temp_file = path.with_name(f'{path.name}.{os.getpid()}.{threading.get_ident()}')
+    try:
+        temp_file.write_bytes(data)
+        if modified_ns is not None:
+            os.utime(temp_file, ns=(modified_ns, modified_ns))
+        temp_file.replace(path)
+    finally:
+        temp_file.unlink(missing_ok=True)
+
+@contextmanager
+def artifact_lock(path: Path) -> Iterator[bool]:
+#===============================================
+    """
+    Hold an exclusive lock on making an artifact, shared by all threads and
+    processes. ``False`` is given if the lock can't be created, as is the case
+    when the artifact's directory isn't writable.
+
+    All the artifacts in a directory share a lock, so a thread holding the
+    lock mustn't try to take it again to make another artifact.
+    """
+    try:
+        lock_file = open(path.parent / ARTIFACT_LOCK_FILE, 'a')
+    except OSError:
+        yield False
+        return
+    with lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+#===============================================================================
+
+def artifact_current(path: Path, version: str, source: str) -> bool:
+#===================================================================
+    """
+    Was an artifact made by the given version from the current source?
+    """
+    try:
+        with open(path.with_name(f'{path.name}{ARTIFACT_STAMP_SUFFIX}')) as fp:
+            stamp = json.load(fp)
+        stat = path.stat()
+        return stamp == {
+            'version': version,
+            'source': source,
+            'modified': stat.st_mtime_ns,
+            'size': stat.st_size
+        }
+    except (OSError, ValueError):
+        return False
+
+def write_artifact(path: Path, data: bytes, version: str, source: str):
+#======================================================================
+    write_atomically(path, data)
+    stat = path.stat()
+    write_atomically(path.with_name(f'{path.name}{ARTIFACT_STAMP_SUFFIX}'), json.dumps({
+        'version': version,
+        'source': source,
+        'modified': stat.st_mtime_ns,
+        'size': stat.st_size
+    }).encode())
+
+def make_json_artifact(path: Path, version: str, source: str, make: Callable[[], Any],
+                       logger: Optional[Any]=None) -> Optional[Any]:
+#====================================================================================
+    """
+    Make sure there's a current copy of a JSON artifact, without reading it,
+    by saving the result of ``make()`` if there isn't.
+
+    None is returned when there is a current copy, otherwise the document
+    that was made but couldn't be saved.
+    """
+    if artifact_current(path, version, source):
+        return None
+    with artifact_lock(path) as locked:
+        if not locked:
+            return make()
+        # Another process may have made the artifact while we waited
+        if artifact_current(path, version, source):
+            return None
+        document = make()
+        try:
+            write_artifact(path, json.dumps(document).encode(), version, source)
+        except OSError as err:
+            if logger is not None:
+                logger.warning(f'Cannot save {path}: {err}')
+            return document
+        if logger is not None:
+            logger.info(f'Saved {path}')
+        return None
+
+#===============================================================================
+#===============================================================================
@@ -0,0 +1,320 @@
+#===============================================================================
+#
+#  Flatmap server
+#
+#  Copyright (c) 2019-2025  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+import base64
+import json
+from pathlib import Path
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+
+#===============================================================================
+
+from .maker import MAKER_SENTINEL
+from .settings import settings
+from .utils import json_map_metadata
+
+#===============================================================================
+
+# Kept in the root of the flatmap directory
+CATALOG_FILE = '.catalog.sqlite'
+
+# Increment when the catalog's schema or the content of entries changes
+CATALOG_VERSION = 2
+
+CATALOG_SCHEMA = """
+    CREATE TABLE flatmaps (
+        directory TEXT PRIMARY KEY,
+        signature TEXT NOT NULL,
+        entry TEXT,
+        id TEXT,
+        taxon TEXT,
+        biological_sex TEXT,
+        style TEXT,
+        created TEXT NOT NULL DEFAULT ''
+    );
+    CREATE INDEX flatmaps_created ON flatmaps(created, directory);
+    CREATE INDEX flatmaps_taxon ON flatmaps(taxon, biological_sex, created);
+    CREATE INDEX flatmaps_style ON flatmaps(style, created);
+"""
+
+#===============================================================================
+
+def flatmap_entry(flatmap_dir: Path) -> Optional[dict[str, Any]]:
+#================================================================
+    """
+    The catalog entry for a map, read from its directory, or None if the
+    directory doesn't contain a map that can be listed.
+    """
+    index_file = flatmap_dir / 'index.json'
+    if not index_file.exists() or (flatmap_dir / MAKER_SENTINEL).exists():
+        return None
+    with open(index_file) as fp:
+        index = json.load(fp)
+    version = index.get('version', 1.0)
+    if float(version) < 1.3:
+        return None
+    metadata: dict[str, Any] = json_map_metadata(str(flatmap_dir), 'metadata')
+    if (('id' not in metadata or flatmap_dir.name != metadata['id'])
+     and ('uuid' not in metadata or flatmap_dir.name != metadata['uuid'].split(':')[-1])):
+        return None
+    flatmap = {
+        'path': str(flatmap_dir),
+        'id': metadata['id'],
+        'name': metadata.get('name', metadata['id']),
+        'source': metadata['source'],
+        'version': version
+    }
+    if 'uuid' in metadata:
+        flatmap['uuid'] = metadata['uuid']
+    if 'style' in index:
+        flatmap['style'] = index['style']
+    if 'created' in metadata:
+        flatmap['created'] = metadata['created']
+        flatmap['creator'] = metadata['creator']
+    if 'git-status' in metadata:
+        flatmap['git-status'] = metadata['git-status']
+    if 'taxon' in metadata:
+        flatmap['taxon'] = metadata['taxon']
+        flatmap['describes'] = metadata['describes'] if 'describes' in metadata else flatmap['taxon']
+    elif 'describes' in metadata:
+        flatmap['taxon'] = metadata['describes']
+        flatmap['describes'] = flatmap['taxon']
+    if 'biological-sex' in metadata:
+        flatmap['biologicalSex'] = metadata['biological-sex']
+    if 'connectivity' in metadata:
+        flatmap['sckan'] = metadata['connectivity']
+    return flatmap
+
+"""
+Files in a map's directory which its catalog entry depends on. The directory's
+own modification time isn't used as the server writes derived files into it.
+"""
+CATALOG_SOURCE_FILES = ('index.json', 'annotations.json', 'index.mbtiles', MAKER_SENTINEL)
+
+def directory_signature(flatmap_dir: Path) -> Optional[str]:
+#===========================================================
+    """
+    Identifies the state of a map's directory, changing whenever the map is
+    made or remade, or None if the path isn't a directory.
+    """
+    if not flatmap_dir.is_dir():
+        return None
+    parts = []
+    for filename in CATALOG_SOURCE_FILES:
+        try:
+            stat = (flatmap_dir / filename).stat()
+            parts.extend((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            parts.append(0)
+    return ':'.join(str(part) for part in parts)
+
+#===============================================================================
+
+def encode_cursor(created: str, directory: str) -> str:
+#======================================================
+    return base64.urlsafe_b64encode(json.dumps([created, directory]).encode()).decode()
+
+def decode_cursor(cursor: str) -> tuple[str, str]:
+#=================================================
+    try:
+        (created, directory) = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if isinstance(created, str) and isinstance(directory, str):
+            return (created, directory)
+    except (TypeError, ValueError):
+        pass
+    raise ValueError('Invalid cursor')
+
+#===============================================================================
+
+class FlatmapCatalog:
+    """
+    A persistent catalog of the maps in ``FLATMAP_ROOT``, shared by all
+    processes serving the directory.
+
+    Map directories are rescanned when the root directory changes, when the
+    catalog is told a map has been made, and otherwise at most once every
+    ``refresh_interval`` seconds. Only maps whose directories have changed
+    since they were last catalogued are read.
+
+    A catalog that isn't ``persistent`` is kept in memory, so that nothing is
+    written into the directory.
+    """
+    def __init__(self, refresh_interval: float, persistent: bool=True):
+        self.__refresh_interval = refresh_interval
+        self.__persistent = persistent
+        self.__lock = threading.Lock()
+        self.__root: Optional[Path] = None
+        self.__db: Optional[sqlite3.Connection] = None
+        self.__root_mtime = 0
+        self.__refreshed = 0.0
+        self.__stale = True
+        self.__flatmaps: dict[str, dict[str, Any]] = {}
+
+    def flatmaps(self) -> list[dict[str, Any]]:
+    #==========================================
+        """
+        The catalog's entries, as copies that may be modified by the caller.
+        """
+        with self.__lock:
+            if not self.__update():
+                return []
+            flatmaps = list(self.__flatmaps.values())
+        return [dict(flatmap) for flatmap in flatmaps]
+
+    def query(self, taxon: Optional[str]=None, sex: Optional[str]=None, style: Optional[str]=None,
+              created_after: Optional[str]=None, latest: bool=False,
+              limit: Optional[int]=None, cursor: Optional[str]=None) -> tuple[list[dict[str, Any]], Optional[str]]:
+    #=========================================================================================================
+        """
+        Entries matching all the given conditions, most recently created first.
+
+        With ``latest`` only the most recent map of each taxon and biological
+        sex is included. At most ``limit`` entries are returned, along with a
+        cursor to pass to get the next entries, if there are any. An invalid
+        cursor raises ``ValueError``.
+        """
+        conditions = ['entry IS NOT NULL']
+        params: list[Any] = []
+        for (column, value) in (('taxon', taxon), ('biological_sex', sex), ('style', style)):
+            if value is not None:
+                conditions.append(f'{column}=?')
+                params.append(value)
+        if created_after is not None:
+            conditions.append('created>?')
+            params.append(created_after)
+        sql = f'SELECT directory, created FROM flatmaps WHERE {" AND ".join(conditions)}'
+        if latest:
+            sql = f'''SELECT directory, created FROM
+                        (SELECT directory, created, ROW_NUMBER() OVER
+                            (PARTITION BY coalesce(taxon, id), biological_sex ORDER BY created DESC, directory DESC)
+                                AS position FROM flatmaps WHERE {" AND ".join(conditions)})
+                        WHERE position=1'''
+        sql = f'SELECT directory, created FROM ({sql})'
+        if cursor is not None:
+            sql += ' WHERE (created, directory) < (?, ?)'
+            params.extend(decode_cursor(cursor))
+        sql += ' ORDER BY created DESC, directory DESC'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit + 1)
+        with self.__lock:
+            if not self.__update():
+                return ([], None)
+            try:
+                rows = self.__db.execute(sql, params).fetchall()      # type: ignore
+            except sqlite3.Error:
+                rows = []
+            flatmaps = [self.__flatmaps[directory] for (directory, _) in rows
+                                                    if directory in self.__flatmaps]
+        next_cursor = None
+        if limit is not None and len(rows) > limit:
+            flatmaps = flatmaps[:limit]
+            next_cursor = encode_cursor(rows[limit-1][1], rows[limit-1][0])
+        return ([dict(flatmap) for flatmap in flatmaps], next_cursor)
+
+    def invalidate(self):
+    #====================
+        """
+        Rescan map directories the next time the catalog is read.
+        """
+        self.__stale = True
+
+    def __open(self, root: Path) -> sqlite3.Connection:
+    #==================================================
+        if self.__db is not None:
+            self.__db.close()
+        try:
+            db = FlatmapCatalog.__connect(str(root / CATALOG_FILE) if self.__persistent else ':memory:')
+        except sqlite3.Error:
+            # The directory isn't writable so keep the catalog in memory
+            db = FlatmapCatalog.__connect(':memory:')
+        self.__root = root
+        self.__db = db
+        return db
+
+    @staticmethod
+    def __connect(database: str) -> sqlite3.Connection:
+    #==================================================
+        db = sqlite3.connect(database, timeout=30, check_same_thread=False)
+        try:
+            db.execute('PRAGMA journal_mode=WAL')
+            with db:
+                if db.execute('PRAGMA user_version').fetchone()[0] != CATALOG_VERSION:
+                    db.execute('DROP TABLE IF EXISTS flatmaps')
+                    db.executescript(CATALOG_SCHEMA)
+                    db.execute(f'PRAGMA user_version={CATALOG_VERSION}')
+        except sqlite3.Error:
+            db.close()
+            raise
+        return db
+
+    def __update(self) -> bool:
+    #==========================
+        root = Path(settings['FLATMAP_ROOT']).resolve()
+        try:
+            root_mtime = root.stat().st_mtime_ns
+        except OSError:
+            return False
+        if (root != self.__root or root_mtime != self.__root_mtime or self.__stale
+         or time.monotonic() >= self.__refreshed + self.__refresh_interval):
+            self.__refresh(root, root_mtime)
+        return True
+
+    def __refresh(self, root: Path, root_mtime: int):
+    #================================================
+        db = self.__open(root) if root != self.__root or self.__db is None else self.__db
+        signatures = {}
+        for flatmap_dir in root.iterdir():
+            if (signature := directory_signature(flatmap_dir)) is not None:
+                signatures[flatmap_dir.name] = signature
+        with db:
+            catalogued = dict(db.execute('SELECT directory, signature FROM flatmaps').fetchall())
+            for directory in catalogued.keys() - signatures.keys():
+                db.execute('DELETE FROM flatmaps WHERE directory=?', (directory,))
+            for (directory, signature) in signatures.items():
+                if catalogued.get(directory) != signature:
+                    try:
+                        entry = flatmap_entry(root / directory)
+                    except (OSError, ValueError, KeyError):
+                        entry = None
+                    if entry is None:
+                        db.execute('REPLACE INTO flatmaps (directory, signature) VALUES (?, ?)',
+                            (directory, signature))
+                    else:
+                        db.execute('''REPLACE INTO flatmaps
+                                        (directory, signature, entry, id, taxon, biological_sex, style, created)
+                                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                            (directory, signature, json.dumps(entry), entry['id'], entry.get('taxon'),
+                             entry.get('biologicalSex'), entry.get('style'), entry.get('created', '')))
+            self.__flatmaps = { directory: json.loads(entry)
+                for (directory, entry) in db.execute(
+                    'SELECT directory, entry FROM flatmaps WHERE entry IS NOT NULL ORDER BY directory') }
+        self.__root_mtime = root_mtime
+        self.__refreshed = time.monotonic()
+        self.__stale = False
+
+#===============================================================================
+
+flatmap_catalog = FlatmapCatalog(settings['CATALOG_REFRESH_INTERVAL'])
+
+#===============================================================================
+#===============================================================================
@@ -18,7 +18,15 @@
 #
 #===============================================================================
 
+from collections import OrderedDict
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from pathlib import Path
+import re
 import sqlite3
+import threading
+import time
+from typing import Any, Optional
 
 #===============================================================================
 
@@ -26,8 +34,68 @@ import flatmapknowledge
 
 #===============================================================================
 
+from ..settings import settings
+from ..utils import object_size
+
+#===============================================================================
+
+# The name of the store's database in its directory
+KNOWLEDGE_BASE = 'knowledgebase.db'
+
+# The number of SQLite virtual machine instructions between checks of a query's running time
+QUERY_PROGRESS_STEPS = 10000
+
+# The number of distinct SQL statements with timing statistics
+QUERY_STATISTICS_LIMIT = 100
+
+# Quoted strings and identifiers, whose whitespace is significant
+SQL_QUOTED = r"""'(?:[^']|'')*'|"(?:[^"]|"")*"|`(?:[^`]|``)*`|\[[^\]]*\]"""
+
+# Quoted text, which is kept, or comments and whitespace, which are replaced by a space
+SQL_TOKENS = re.compile(rf"""({SQL_QUOTED})|(?:--[^\n]*|/\*.*?(?:\*/|$)|\s)+""", re.DOTALL)
+
+#===============================================================================
+
+def tune_connection(db: sqlite3.Connection):
+#===========================================
+    """
+    Set a read-only connection's memory map and page cache sizes.
+    """
+    try:
+        db.execute('PRAGMA query_only=1')
+        db.execute(f'PRAGMA mmap_size={settings["KNOWLEDGE_MMAP_SIZE"]}')
+        db.execute(f'PRAGMA cache_size=-{settings["KNOWLEDGE_CACHE_SIZE"]//1024}')
+    except sqlite3.Error:
+        pass
+
+@contextmanager
+def query_time_limit(db: sqlite3.Connection, time_limit: Optional[float]) -> Iterator[None]:
+#===========================================================================================
+    """
+    Interrupt statements run on the connection when the time limit has passed.
+    """
+    if time_limit is None:
+        yield
+        return
+    deadline = time.monotonic() + time_limit
+    db.set_progress_handler(lambda: time.monotonic() > deadline, QUERY_PROGRESS_STEPS)
+    try:
+        yield
+    finally:
+        db.set_progress_handler(None, 0)
+
+def query_error(error: sqlite3.Error, time_limit: Optional[float]) -> str:
+#=========================================================================
+    if (time_limit is not None and isinstance(error, sqlite3.OperationalError)
+    and str(error) == 'interrupted'):
+        return f'Query exceeded its time limit of {time_limit} seconds'
+    return str(error)
+
+#===============================================================================
+
 class KnowledgeStore(flatmapknowledge.KnowledgeStore):
     def __init__(self, directory_path, create=False, update=False):
+        self.__update = update
         try:
             super().__init__(directory_path, create=create, read_only=not update, verbose=False)
             self.__error = None
@@ -38,18 +106,280 @@ class KnowledgeStore(flatmapknowledge.KnowledgeStore):
     def error(self):
         return self.__error
 
-    def query(self, sql, params):
+    def close(self):
+        super().close()
+        if self.__update:
+            # Our cached query results may now be out of date
+            knowledge_stores.changed()
+
+    def query(self, sql, params, max_rows: Optional[int]=None, time_limit: Optional[float]=None):
+        """
+        Run a query, stopping it with an error if it runs for more than
+        ``time_limit`` seconds. At most ``max_rows`` rows are returned, with
+        ``truncated`` set in the result if there were more.
+        """
         if self.__error is not None:
             return { 'error': self.__error }
         try:
-            cursor = self.db.execute(sql, params)  # type: ignore
-            result = {
-                'keys': tuple(d[0] for d in cursor.description),
-                'values': cursor.fetchall()
+            with query_time_limit(self.db, time_limit):     # type: ignore
+                cursor = self.db.execute(sql, params)       # type: ignore
+                keys = tuple(d[0] for d in cursor.description) if cursor.description else ()
+                if max_rows is None:
+                    values = cursor.fetchall()
+                else:
+                    values = cursor.fetchmany(max_rows + 1)
+                cursor.close()
+            result: dict[str, Any] = {
+                'keys': keys,
+                'values': values[:max_rows] if max_rows is not None else values
             }
-            cursor.close()
+            if max_rows is not None and len(values) > max_rows:
+                result['truncated'] = True
             return result
         except (sqlite3.DatabaseError, sqlite3.ProgrammingError, sqlite3.OperationalError) as error:
-            return { 'error': str(error) }
+            return { 'error': query_error(error, time_limit) }
+
+class UnavailableKnowledgeStore:
+    """
+    Stands in for a knowledge store that couldn't be opened, giving the
+    reason as the result of every query.
+    """
+    def __init__(self, error: str):
+        self.__error = error
+
+    @property
+    def error(self):
+        return self.__error
+
+    def knowledge_sources(self) -> list[str]:
+        return []
+
+    def query(self, sql, params, max_rows: Optional[int]=None, time_limit: Optional[float]=None):
+        return { 'error': self.__error }
+
+#===============================================================================
+
+class KnowledgeStorePool:
+    """
+    Read-only connections to a knowledge store, kept open between queries.
+
+    Each thread that queries the store has its own connection, which is
+    reopened only when the store's database file is replaced.
+    """
+    def __init__(self, directory_path: str):
+        self.__directory_path = directory_path
+        self.__database = Path(directory_path) / KNOWLEDGE_BASE
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.__stores: list[KnowledgeStore] = []
+        self.__changes = 0
+
+    def store(self) -> KnowledgeStore|UnavailableKnowledgeStore:
+    #===========================================================
+        """
+        The calling thread's connection to the store. The connection is owned
+        by the pool and must not be closed.
+        """
+        signature = self.__signature()
+        store: Optional[KnowledgeStore] = getattr(self.__local, 'store', None)
+        if store is not None:
+            if self.__local.signature == signature:
+                return store
+            self.__local.store = None
+            self.__close(store)
+        store = KnowledgeStore(self.__directory_path)
+        if (error := store.error) is not None:
+            # Only working connections are kept, so that a failed open is retried
+            try:
+                store.close()
+            except sqlite3.Error:
+                pass
+            return UnavailableKnowledgeStore(error)
+        tune_connection(store.db)   # type: ignore
+        self.__local.store = store
+        self.__local.signature = signature
+        with self.__lock:
+            self.__stores.append(store)
+        return store
+
+    def connect(self) -> sqlite3.Connection:
+    #=======================================
+        """
+        A new read-only connection to the store's database, which may be used
+        by any thread, one at a time, and must be closed by the caller.
+        """
+        db = sqlite3.connect(f'{self.__database.resolve().as_uri()}?mode=ro', uri=True,
+                             check_same_thread=False)
+        tune_connection(db)
+        return db
+
+    def changed(self):
+    #=================
+        """
+        Note that the store has been written to by this process.
+        """
+        with self.__lock:
+            self.__changes += 1
+
+    def generation(self) -> tuple:
+    #=============================
+        """
+        Identifies the content of the store, changing whenever the store is
+        written to or replaced.
+        """
+        parts: list[Any] = [self.__changes]
+        for path in (self.__database, self.__database.with_name(f'{self.__database.name}-wal')):
+            try:
+                stat = path.stat()
+                parts.extend((stat.st_ino, stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                parts.append(None)
+        return tuple(parts)
+
+    def close(self):
+    #===============
+        with self.__lock:
+            stores = self.__stores
+            self.__stores = []
+        for store in stores:
+            try:
+                store.close()
+            except sqlite3.Error:
+                pass
+
+    def __close(self, store: KnowledgeStore):
+    #========================================
+        with self.__lock:
+            if store in self.__stores:
+                self.__stores.remove(store)
+        store.close()
+
+    def __signature(self) -> Optional[tuple[int, int]]:
+    #==================================================
+        try:
+            stat = self.__database.stat()
+            return (stat.st_dev, stat.st_ino)
+        except OSError:
+            return None
+
+#===============================================================================
+
+knowledge_stores = KnowledgeStorePool(settings['FLATMAP_ROOT'])
+
+#===============================================================================
+
+def normalised_sql(sql: str) -> str:
+#===================================
+    """
+    SQL with comments removed and runs of whitespace outside of quotes replaced
+    by a single space.
+    """
+    return SQL_TOKENS.sub(lambda match: match.group(1) or ' ', sql).strip()
+
+#===============================================================================
+
+class QueryCache:
+    """
+    Results of knowledge store queries, keyed by their SQL and parameters and
+    valid until the store changes.
+
+    Results are evicted, least recently used first, when the estimated memory
+    they use exceeds ``max_bytes``, with nothing cached if it is zero. Cached
+    results are shared and must not be modified. The number of and time taken
+    by recent queries are also recorded.
+    """
+    def __init__(self, max_bytes: int):
+        self.__max_bytes = max_bytes
+        self.__results: OrderedDict[tuple[str, tuple], tuple[tuple, int, dict]] = OrderedDict()
+        self.__queries: OrderedDict[str, dict[str, Any]] = OrderedDict()
+        self.__bytes = 0
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+        self.__lock = threading.Lock()
+
+    def clear(self):
+    #===============
+        with self.__lock:
+            self.__results.clear()
+            self.__bytes = 0
+
+    def query(self, sql: str, params: list[str], execute: Callable[[], dict]) -> dict:
+    #=================================================================================
+        """
+        The result of a query, obtained by calling ``execute()`` if there isn't
+        a current result in the cache. Errors aren't cached.
+        """
+        start_time = time.perf_counter()
+        generation = knowledge_stores.generation()
+        sql = normalised_sql(sql)
+        key = (sql, tuple(params))
+        result = None
+        with self.__lock:
+            if (entry := self.__results.get(key)) is not None:
+                if entry[0] == generation:
+                    self.__results.move_to_end(key)
+                    self.__hits += 1
+                    result = entry[2]
+                else:
+                    del self.__results[key]
+                    self.__bytes -= entry[1]
+            if result is None:
+                self.__misses += 1
+        hit = result is not None
+        if result is None:
+            result = execute()
+            if 'error' not in result and self.__max_bytes > 0:
+                size = object_size(result)
+                if size <= self.__max_bytes:
+                    with self.__lock:
+                        if (entry := self.__results.pop(key, None)) is not None:
+                            self.__bytes -= entry[1]
+                        self.__results[key] = (generation, size, result)
+                        self.__bytes += size
+                        while self.__bytes > self.__max_bytes:
+                            (_, evicted) = self.__results.popitem(last=False)
+                            self.__bytes -= evicted[1]
+                            self.__evictions += 1
+        self.__record(sql, hit, time.perf_counter() - start_time)
+        return result
+
+    def statistics(self) -> dict[str, Any]:
+    #======================================
+        with self.__lock:
+            return {
+                'results': len(self.__results),
+                'bytes': self.__bytes,
+                'max-bytes': self.__max_bytes,
+                'hits': self.__hits,
+                'misses': self.__misses,
+                'hit-ratio': self.__hits/(self.__hits + self.__misses) if self.__hits + self.__misses else 0.0,
+                'evictions': self.__evictions,
+                'queries': [ {'sql': sql, **query} for (sql, query) in reversed(self.__queries.items()) ]
+            }
+
+    def __record(self, sql: str, hit: bool, seconds: float):
+    #=======================================================
+        with self.__lock:
+            if (query := self.__queries.get(sql)) is None:
+                query = self.__queries[sql] = {
+                    'count': 0,
+                    'hits': 0,
+                    'total-time': 0.0,
+                    'max-time': 0.0
+                }
+                if len(self.__queries) > QUERY_STATISTICS_LIMIT:
+                    self.__queries.popitem(last=False)
+            else:
+                self.__queries.move_to_end(sql)
+            query['count'] += 1
+            if hit:
+                query['hits'] += 1
+            query['total-time'] += seconds
+            query['max-time'] = max(query['max-time'], seconds)
+
+#===============================================================================
+
+knowledge_query_cache = QueryCache(settings['KNOWLEDGE_QUERY_CACHE_SIZE'])
 
 #===============================================================================
@@ -23,6 +23,7 @@ import importlib.resources
 import json
 import os
 from pathlib import Path
+import threading
 from typing import cast, Optional
 
 #===============================================================================
@@ -36,6 +37,7 @@ import scipy.sparse.csgraph as csgraph
 
 #===============================================================================
 
+from ..artifacts import artifact_lock, make_json_artifact, map_files_source, write_atomically
 from ..settings import settings
 from ..utils import json_map_metadata
 
@@ -57,6 +59,12 @@ CACHED_MAP_HIERARCHY = 'hierarchy.json'
 CACHED_SPARC_HIERARCHY = 'sparc-hierarchy.json'
 CACHED_SPARC_DISTANCES = 'sparc-distances.npy'
 
+# The number of rows of the distance matrix calculated at a time
+SPARC_DISTANCE_ROWS = 256
+
+# A map's hierarchy is rebuilt when any of these change
+MAP_HIERARCHY_SOURCE_FILES = ('index.json', 'annotations.json', 'index.mbtiles')
+
 #===============================================================================
 
 ONTOLOGY_RESOURCE = importlib.resources.files() / 'ontologies'
@@ -255,16 +263,46 @@ class SparcHierarchy:
 
     def __create_sparc_distances(self):
     #==================================
+        # The matrix is memory mapped so that its pages are shared by all
+        # processes using it and are only read when needed
+        if (distances := self.__load_sparc_distances()) is None:
+            with artifact_lock(self.__distances_file):
+                # Another process may have saved distances while we waited
+                if (distances := self.__load_sparc_distances()) is None:
+                    self.__save_sparc_distances()
+                    distances = self.__load_sparc_distances()
+        self.__distances = distances
+
+    def __load_sparc_distances(self) -> Optional[np.ndarray]:
+    #========================================================
         try:
-            self.__distances = np.load(self.__distances_file)
-            return
+            distances = np.load(self.__distances_file, mmap_mode='r')
+            if distances.shape == (self.__igraph.vcount(), self.__igraph.vcount()):
+                return distances
         except Exception:
             pass
+        return None
+
+    def __save_sparc_distances(self):
+    #================================
+        # Distances are calculated a block of rows at a time and written
+        # straight to the file, so the full matrix is never held in memory
         adj = self.__igraph.get_adjacency_sparse()
-        distances = csgraph.shortest_path(csgraph=adj, directed=True, unweighted=True, method='D')
-        distances[distances == np.inf] = 0
-        self.__distances = distances.astype(np.uint8)
-        np.save(self.__distances_file, self.__distances)
+        size = self.__igraph.vcount()
+        temp_file = self.__distances_file.with_name(
+                        f'{self.__distances_file.name}.{os.getpid()}.{threading.get_ident()}')
+        try:
+            distances = np.lib.format.open_memmap(temp_file, mode='w+', dtype=np.uint8, shape=(size, size))
+            for start in range(0, size, SPARC_DISTANCE_ROWS):
+                rows = csgraph.shortest_path(csgraph=adj, directed=True, unweighted=True, method='D',
+                                             indices=np.arange(start, min(start + SPARC_DISTANCE_ROWS, size)))
+                rows[rows == np.inf] = 0
+                distances[start:start + len(rows)] = rows.astype(np.uint8)
+            distances.flush()
+            del distances
+            temp_file.replace(self.__distances_file)
+        finally:
+            temp_file.unlink(missing_ok=True)
 
     def __create_sparc_hierarchy(self, uberon_source: str, interlex_source: str):
     #============================================================================
@@ -272,8 +310,7 @@ class SparcHierarchy:
         self.__add_ilx_terms(interlex_source)
         self.__graph.graph['version'] = SPARC_HIERARCHY_VERSION
         graph_json = nx.node_link_data(self.__graph, edges='links')     # type: ignore
-        with open(self.__hierarchy_file, 'w') as fp:
-            json.dump(graph_json, fp)
+        write_atomically(self.__hierarchy_file, json.dumps(graph_json).encode())
         if self.__distances_file.exists():
             self.__distances_file.unlink()
 
@@ -298,16 +335,18 @@ class SparcHierarchy:
                     new_parents.append(ilx_term)
             if len(new_parents) == len(have_ilx_parents):
                 # No progress — remaining terms form a cycle or reference unknown parents
-                for t in set(new_parents):
-                    missing_parents = [p.id for p in t.parents if p.id not in self.__graph]
-                    settings['LOGGER'].warning(
-                        f'Unresolved Interlex term: {t.uri.id}; missing parents: {missing_parents}'
-                    )
+                if (logger := settings.get('LOGGER')) is not None:
+                    for t in set(new_parents):
+                        missing_parents = [p.id for p in t.parents if p.id not in self.__graph]
+                        logger.warning(
+                            f'Unresolved Interlex term: {t.uri.id}; missing parents: {missing_parents}'
+                        )
                 break
             have_ilx_parents = new_parents
             depth += 1
             if len(have_ilx_parents) and depth >= 3:
-                settings['LOGGER'].warning('Some Interlex parts are too deeply nested')
+                if (logger := settings.get('LOGGER')) is not None:
+                    logger.warning('Some Interlex parts are too deeply nested')
                 break
 
     def __add_ilx_child(self, ilx: IlxTerm):
@@ -389,18 +428,22 @@ class AnatomicalHierarchy:
     def __init__(self):
         self.__sparc_hierarchy = None
 
-    def get_hierarchy(self, flatmap: str) -> dict:
-    #=============================================
-        hierarchy_file = os.path.join(settings['FLATMAP_ROOT'], flatmap, CACHED_MAP_HIERARCHY)
-        try:
-            # Do we already have the current version of the map's hierarchy?
-            with open(hierarchy_file) as fp:
-                hierarchy = json.load(fp)
-                if hierarchy.get('graph', {}).get('version', '') >= MAP_TREE_VERSION:
-                    return hierarchy
-                settings['LOGGER'].info(f'Rebuilding term hierarchy for {flatmap}: old version: {hierarchy.get('graph', {}).get('version', '')}')
-        except Exception:
-            settings['LOGGER'].info(f'Rebuilding term hierarchy for {flatmap}: cannot load (file missing?)')
+    def save_hierarchy(self, flatmap: str) -> Optional[dict]:
+    #========================================================
+        """
+        Make sure there's a current saved hierarchy in the map's directory,
+        without reading it. The hierarchy is only returned if it had to be
+        made and couldn't be saved.
+        """
+        map_path = Path(settings['FLATMAP_ROOT']) / flatmap
+        return make_json_artifact(map_path / CACHED_MAP_HIERARCHY, MAP_TREE_VERSION,
+                                  map_files_source(map_path, MAP_HIERARCHY_SOURCE_FILES),
+                                  lambda: self.__make_map_hierarchy(flatmap), settings.get('LOGGER'))
+
+    def __make_map_hierarchy(self, flatmap: str) -> dict:
+    #===================================================
+        if (logger := settings.get('LOGGER')) is not None:
+            logger.info(f'Rebuilding term hierarchy for {flatmap}')
 
         self.__sparc_hierarchy = SparcHierarchy(UBERON_ONTOLOGY, NPO_ONTOLOGY)
 
@@ -433,11 +476,6 @@ class AnatomicalHierarchy:
             if (target := map_targets_by_source.get(link['source'])) is not None:
                 link['target'] = target
 
-        # Save the hierarchy for future requests
-        with open(hierarchy_file, 'w') as fp:
-            json.dump(full_hierarchy, fp)
-        settings['LOGGER'].info(f'Saved rebuilt term hierarchy: {hierarchy_file}')
-
         # Free memory used by the SPARC hierarchy
         del self.__sparc_hierarchy
         self.__sparc_hierarchy = None
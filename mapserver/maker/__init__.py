@@ -39,7 +39,9 @@ import uvloop
 
 #===============================================================================
 
+from ..pmtiles import pmtiles_archives
 from ..settings import settings
+from ..tiles import tile_databases
 
 from mapmaker import MapMaker
 import mapmaker.utils as utils
@@ -352,6 +354,16 @@ class Manager(threading.Thread):
                             info = ', '.join([ f'{key}: {value}' for key in MAKER_RESULT_KEYS
                                             if (value := process.result.get(key)) is not None ])
                             self.__log.info(f'Mapmaker succeeded: {process.id}, Map {info}')
+                            # Import here as the catalog depends on this module
+                            from ..catalog import flatmap_catalog
+                            flatmap_catalog.invalidate()
+                            if (map_uuid := process.result.get('uuid')) is not None:
+                                # Discard any open tile databases and cached tiles of a rebuilt map
+                                tile_databases.invalidate(map_uuid.split(':')[-1])
+                                pmtiles_archives.invalidate(map_uuid.split(':')[-1])
+                                # Make the map's derived files before they are first requested
+                                from ..precompute import precomputer
+                                precomputer.submit(map_uuid.split(':')[-1], self.__log)
                         else:
                             self.__log.error(f'Mapmaker FAILED: {process.id}')
                         self.__running_process = None
@@ -0,0 +1,176 @@
+#===============================================================================
+#
+#  Flatmap server
+#
+#  Copyright (c) 2019-2025  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+from collections.abc import Iterable
+import json
+from pathlib import Path
+import sqlite3
+from typing import Any, Optional
+
+#===============================================================================
+
+from .artifacts import artifact_lock, map_files_source, write_atomically
+from .settings import settings
+from .utils import json_map_metadata
+
+#===============================================================================
+
+"""
+The paths of a map's pathways, indexed by path id
+"""
+PATHWAYS_INDEX = 'pathways.sqlite'
+
+# Increment when the index's schema or content changes
+PATHWAYS_INDEX_VERSION = 2
+
+PATHWAYS_INDEX_SCHEMA = """
+    CREATE TABLE metadata (name TEXT PRIMARY KEY, value TEXT);
+    CREATE TABLE paths (id TEXT PRIMARY KEY, path TEXT NOT NULL);
+    CREATE TABLE node_paths (node TEXT NOT NULL, path_id TEXT NOT NULL);
+    CREATE INDEX node_paths_node ON node_paths(node);
+"""
+
+"""
+Files in a map's directory which its pathways are obtained from
+"""
+PATHWAYS_SOURCE_FILES = ('index.json', 'annotations.json', 'index.mbtiles')
+
+# Maps whose index couldn't be written, as (map, source)
+UNINDEXED_PATHWAYS: set[tuple[str, str]] = set()
+
+#===============================================================================
+
+def pathways_source(map_path: Path) -> str:
+#==========================================
+    """
+    Identifies the version of the files that a map's pathways are read from.
+    """
+    return map_files_source(map_path, PATHWAYS_SOURCE_FILES)
+
+def build_pathways_index(map_uuid: str) -> bool:
+#===============================================
+    """
+    (Re)build the index of a map's pathways, returning False if the index
+    can't be written. The caller should hold the index's artifact lock.
+    """
+    map_path = Path(settings['FLATMAP_ROOT']) / map_uuid
+    source = pathways_source(map_path)
+    if (map_uuid, source) in UNINDEXED_PATHWAYS:
+        return False
+    pathways = json_map_metadata(map_uuid, 'pathways')
+    paths: dict[str, Any] = pathways.get('paths', {})
+    node_paths: dict[str, list[str]] = pathways.get('node-paths', {})
+    try:
+        # The index is made in memory and then saved so readers never see a partial index
+        db = sqlite3.connect(':memory:')
+        try:
+            db.executescript(PATHWAYS_INDEX_SCHEMA)
+            db.executemany('INSERT INTO metadata (name, value) VALUES (?, ?)',
+                           [('version', str(PATHWAYS_INDEX_VERSION)), ('source', source)])
+            db.executemany('INSERT INTO paths (id, path) VALUES (?, ?)',
+                           [(path_id, json.dumps(path)) for (path_id, path) in paths.items()])
+            db.executemany('INSERT INTO node_paths (node, path_id) VALUES (?, ?)',
+                           [(node, path_id) for (node, path_ids) in node_paths.items()
+                                                for path_id in path_ids])
+            db.commit()
+            data = db.serialize()
+        finally:
+            db.close()
+        write_atomically(map_path / PATHWAYS_INDEX, data)
+    except (OSError, sqlite3.Error):
+        UNINDEXED_PATHWAYS.add((map_uuid, source))
+        return False
+    return True
+
+def open_pathways_index(map_uuid: str) -> Optional[sqlite3.Connection]:
+#======================================================================
+    """
+    A read-only connection to a current index of a map's pathways, building
+    the index if need be, or None if there's no index.
+    """
+    map_path = Path(settings['FLATMAP_ROOT']) / map_uuid
+    index_file = map_path / PATHWAYS_INDEX
+    source = pathways_source(map_path)
+    if (db := current_pathways_index(index_file, source)) is not None:
+        return db
+    with artifact_lock(index_file) as locked:
+        # Another process may have built the index while we waited
+        if locked and (db := current_pathways_index(index_file, source)) is not None:
+            return db
+        if build_pathways_index(map_uuid):
+            return current_pathways_index(index_file, source)
+    return None
+
+def current_pathways_index(index_file: Path, source: str) -> Optional[sqlite3.Connection]:
+#=========================================================================================
+    if index_file.exists():
+        try:
+            db = sqlite3.connect(f'{index_file.resolve().as_uri()}?mode=ro', uri=True)
+            try:
+                metadata = dict(db.execute('SELECT name, value FROM metadata').fetchall())
+                if (metadata.get('version') == str(PATHWAYS_INDEX_VERSION)
+                and metadata.get('source') == source):
+                    return db
+            except sqlite3.Error:
+                pass
+            db.close()
+        except sqlite3.Error:
+            pass
+    return None
+
+#===============================================================================
+
+def get_paths(map_uuid: str, path_ids: Iterable[str]) -> dict[str, dict[str, Any]]:
+#==================================================================================
+    """
+    The pathways of a map with the given ids, reading only those paths
+    from the map's pathways index.
+    """
+    path_ids = list(path_ids)
+    if len(path_ids) == 0:
+        return {}
+    if (db := open_pathways_index(map_uuid)) is not None:
+        try:
+            rows = db.execute(f'SELECT id, path FROM paths WHERE id IN ({",".join(len(path_ids)*"?")})',
+                              path_ids).fetchall()
+            return { path_id: json.loads(path) for (path_id, path) in rows }
+        except sqlite3.Error:
+            pass
+        finally:
+            db.close()
+    paths = json_map_metadata(map_uuid, 'pathways').get('paths', {})
+    return { path_id: paths[path_id] for path_id in path_ids if path_id in paths }
+
+def paths_through(map_uuid: str, node: str) -> list[str]:
+#========================================================
+    """
+    The ids of the paths of a map which pass through a feature.
+    """
+    if (db := open_pathways_index(map_uuid)) is not None:
+        try:
+            return [row[0] for row in db.execute('SELECT path_id FROM node_paths WHERE node=?', (node,))]
+        except sqlite3.Error:
+            pass
+        finally:
+            db.close()
+    return list(json_map_metadata(map_uuid, 'pathways').get('node-paths', {}).get(node, []))
+
+#===============================================================================
+#===============================================================================
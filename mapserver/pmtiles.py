@@ -0,0 +1,320 @@
+#===============================================================================
+#
+#  Flatmap server
+#
+#  Copyright (c) 2019-2025  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from collections.abc import Iterator
+from dataclasses import dataclass
+import gzip
+import mmap
+from pathlib import Path
+import struct
+import threading
+from typing import Optional
+
+#===============================================================================
+
+from .settings import settings
+from .tiles import TileDatabase
+
+#===============================================================================
+
+# Size of the pieces a large byte range is streamed in
+PMTILES_CHUNK_SIZE = 1024*1024
+
+#===============================================================================
+
+# See https://github.com/protomaps/PMTiles/blob/main/spec/v3/spec.md
+
+PMTILES_HEADER_SIZE = 127
+PMTILES_MAGIC = b'PMTiles'
+PMTILES_VERSION = 3
+
+PMTILES_COMPRESSION_NONE = 1
+PMTILES_COMPRESSION_GZIP = 2
+
+PMTILES_TILE_MEDIA_TYPES = {
+    1: 'application/octet-stream',      # MVT, served as for MBTiles vector tiles
+    2: 'image/png',
+    3: 'image/jpeg',
+    4: 'image/webp',
+    5: 'image/avif',
+}
+PMTILES_TILE_TYPE_MVT = 1
+
+#===============================================================================
+
+@dataclass
+class PMTilesHeader:
+    root_offset: int
+    root_length: int
+    metadata_offset: int
+    metadata_length: int
+    leaf_directory_offset: int
+    leaf_directory_length: int
+    tile_data_offset: int
+    tile_data_length: int
+    internal_compression: int
+    tile_compression: int
+    tile_type: int
+    min_zoom: int
+    max_zoom: int
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'PMTilesHeader':
+    #===================================================
+        if (len(data) < PMTILES_HEADER_SIZE
+         or data[0:7] != PMTILES_MAGIC or data[7] != PMTILES_VERSION):
+            raise IOError('Unsupported PMTiles archive')
+        offsets = struct.unpack_from('<8Q', data, 8)
+        (internal_compression, tile_compression, tile_type,
+         min_zoom, max_zoom) = struct.unpack_from('<5B', data, 97)
+        return cls(*offsets, internal_compression, tile_compression, tile_type, min_zoom, max_zoom)
+
+#===============================================================================
+
+def zxy_to_tile_id(z: int, x: int, y: int) -> int:
+#=================================================
+    """
+    A tile's position on the Hilbert curve that orders all tiles in an archive.
+    """
+    if z > 31 or x < 0 or y < 0 or x >= (1 << z) or y >= (1 << z):
+        raise ValueError('Tile coordinates out of range')
+    tile_id = ((1 << (2*z)) - 1)//3     # Number of tiles at lower zoom levels
+    s = 1 << z
+    while (s := s >> 1) > 0:
+        rx = 1 if (x & s) else 0
+        ry = 1 if (y & s) else 0
+        tile_id += s*s*((3*rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x = s - 1 - x
+                y = s - 1 - y
+            (x, y) = (y, x)
+    return tile_id
+
+#===============================================================================
+
+class TileIndex:
+    """
+    The location of every tile in a PMTiles archive, with the root and all
+    leaf directories decoded into compact, sorted, arrays.
+    """
+    def __init__(self, archive_map: mmap.mmap, header: PMTilesHeader):
+        self.__map = archive_map
+        self.__header = header
+        self.__tile_ids = array('Q')
+        self.__run_lengths = array('L')
+        self.__offsets = array('Q')
+        self.__lengths = array('L')
+        self.__add_directory(header.root_offset, header.root_length)
+
+    def __len__(self):
+        return len(self.__tile_ids)
+
+    def find(self, tile_id: int) -> Optional[tuple[int, int]]:
+    #=========================================================
+        """
+        The absolute offset and length of a tile's data, or None if the
+        tile isn't in the archive.
+        """
+        index = bisect_right(self.__tile_ids, tile_id) - 1
+        if index >= 0 and tile_id < self.__tile_ids[index] + self.__run_lengths[index]:
+            return (self.__offsets[index], self.__lengths[index])
+
+    def __add_directory(self, offset: int, length: int):
+    #===================================================
+        data = self.__map[offset:offset+length]
+        if self.__header.internal_compression == PMTILES_COMPRESSION_GZIP:
+            data = gzip.decompress(data)
+        elif self.__header.internal_compression != PMTILES_COMPRESSION_NONE:
+            raise IOError('Unsupported PMTiles directory compression')
+        position = 0
+        def varint() -> int:
+            nonlocal position
+            value = 0
+            shift = 0
+            while True:
+                byte = data[position]
+                position += 1
+                value |= (byte & 0x7F) << shift
+                if byte < 0x80:
+                    return value
+                shift += 7
+        count = varint()
+        tile_ids = []
+        last_id = 0
+        for _ in range(count):
+            last_id += varint()
+            tile_ids.append(last_id)
+        run_lengths = [varint() for _ in range(count)]
+        lengths = [varint() for _ in range(count)]
+        offsets = []
+        for n in range(count):
+            value = varint()
+            if value == 0 and n > 0:
+                offsets.append(offsets[n-1] + lengths[n-1])
+            else:
+                offsets.append(value - 1)
+        # Entries are in tile id order, as are leaf directories, so appending
+        # tile entries as we go keeps the index sorted
+        for n in range(count):
+            if run_lengths[n] == 0:
+                self.__add_directory(self.__header.leaf_directory_offset + offsets[n], lengths[n])
+            else:
+                self.__tile_ids.append(tile_ids[n])
+                self.__run_lengths.append(run_lengths[n])
+                self.__offsets.append(self.__header.tile_data_offset + offsets[n])
+                self.__lengths.append(lengths[n])
+
+#===============================================================================
+
+class PMTilesArchive:
+    """
+    A read-only memory map of a map's PMTiles archive.
+
+    Pages are shared with the operating system's file cache, so all workers
+    reading an archive use the same physical memory, however large it is.
+    """
+    def __init__(self, map_uuid: str, layer: str):
+        self.__path = path = Path(settings['FLATMAP_ROOT']) / map_uuid / f'{layer}.pmtiles'
+        try:
+            self.__signature = TileDatabase.file_signature(path)
+            with open(path, 'rb') as fp:
+                self.__mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            raise IOError('Cannot read PMTiles archive')
+        self.__size = len(self.__mmap)
+        self.__header: Optional[PMTilesHeader] = None
+        self.__tile_index: Optional[TileIndex] = None
+        self.__index_lock = threading.Lock()
+
+    @property
+    def path(self) -> Path:
+        return self.__path
+
+    @property
+    def signature(self) -> tuple[int, int, int]:
+        return self.__signature
+
+    @property
+    def header(self) -> PMTilesHeader:
+        if self.__header is None:
+            self.__header = PMTilesHeader.from_bytes(self.__mmap[0:PMTILES_HEADER_SIZE])
+        return self.__header
+
+    @property
+    def size(self) -> int:
+        return self.__size
+
+    def current(self) -> bool:
+    #=========================
+        try:
+            return TileDatabase.file_signature(self.__path) == self.__signature
+        except OSError:
+            return False
+
+    def read(self, start: int, end: int) -> bytes:
+    #=============================================
+        """
+        Return the bytes from ``start`` to ``end``, inclusive.
+        """
+        return self.__mmap[start:end+1]
+
+    def tile(self, z: int, x: int, y: int) -> Optional[bytes]:
+    #=========================================================
+        """
+        Get a tile's data, as stored in the archive.
+        """
+        if self.__tile_index is None:
+            with self.__index_lock:
+                if self.__tile_index is None:
+                    try:
+                        self.__tile_index = TileIndex(self.__mmap, self.header)
+                    except (IndexError, OSError, ValueError):
+                        raise IOError('Cannot read PMTiles directory')
+        try:
+            location = self.__tile_index.find(zxy_to_tile_id(z, x, y))
+        except ValueError:
+            return None
+        if location is not None:
+            return self.__mmap[location[0]:location[0]+location[1]]
+
+    def stream(self, start: int, end: int) -> Iterator[bytes]:
+    #=========================================================
+        """
+        Yield the bytes from ``start`` to ``end``, inclusive, in chunks.
+        """
+        # The generator keeps a reference to the map so that it stays open
+        # even if the archive is evicted while a response is streaming
+        archive_map = self.__mmap
+        while start <= end:
+            chunk_end = min(end, start + PMTILES_CHUNK_SIZE - 1)
+            yield archive_map[start:chunk_end+1]
+            start = chunk_end + 1
+
+#===============================================================================
+
+class PMTilesArchives:
+    """
+    Memory mapped PMTiles archives, keyed by map and layer. An archive
+    is unmapped when it is no longer referenced, after it has been evicted,
+    least recently used first, when there are more than ``max_open``.
+    """
+    def __init__(self, max_open: int):
+        self.__max_open = max(1, max_open)
+        self.__archives: OrderedDict[tuple[str, str], PMTilesArchive] = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def clear(self):
+    #===============
+        with self.__lock:
+            self.__archives.clear()
+
+    def get(self, map_uuid: str, layer: str) -> PMTilesArchive:
+    #==========================================================
+        key = (map_uuid, layer)
+        with self.__lock:
+            archive = self.__archives.get(key)
+            if archive is not None:
+                if archive.current():
+                    self.__archives.move_to_end(key)
+                    return archive
+                del self.__archives[key]
+        archive = PMTilesArchive(map_uuid, layer)
+        with self.__lock:
+            self.__archives[key] = archive
+            while len(self.__archives) > self.__max_open:
+                self.__archives.popitem(last=False)
+        return archive
+
+    def invalidate(self, map_uuid: str):
+    #===================================
+        with self.__lock:
+            for key in [key for key in self.__archives if key[0] == map_uuid]:
+                del self.__archives[key]
+
+#===============================================================================
+
+pmtiles_archives = PMTilesArchives(settings['TILE_DATABASE_LIMIT'])
+
+#===============================================================================
+#===============================================================================
@@ -0,0 +1,199 @@
+#===============================================================================
+#
+#  Flatmap server
+#
+#  Copyright (c) 2019-2025  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+"""
+Make all the files the server derives from a map's files, so that they're
+ready before the map is first requested.
+"""
+
+#===============================================================================
+
+import argparse
+from collections.abc import Callable
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+import logging
+import multiprocessing
+from pathlib import Path
+import threading
+import time
+from typing import Optional
+
+#===============================================================================
+
+from .knowledge.hierarchy import AnatomicalHierarchy, CACHED_MAP_HIERARCHY, CACHED_SPARC_HIERARCHY
+from .pathways import open_pathways_index
+from .settings import settings
+from .tiles import TileDatabase
+from .utils import gzip_sidecar, metadata_cache, save_annotation_sections
+
+#===============================================================================
+
+# Files which are sent compressed, in addition to the map's SVG
+COMPRESSED_MAP_FILES = ['style.json', 'mapmaker.log.json', CACHED_MAP_HIERARCHY]
+
+LOG_FORMAT = '%(asctime)s %(levelname)s: %(message)s'
+
+#===============================================================================
+
+def initialise_logging():
+#========================
+    """
+    Log to stderr, as the server does, so that warnings from making derived
+    files are seen.
+    """
+    logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+    settings['LOGGER'] = logging.getLogger('precompute')
+
+#===============================================================================
+
+def make_annotation_sections(map_uuid: str, map_path: Path):
+#===========================================================
+    if (map_path / 'annotations.json').exists():
+        save_annotation_sections(map_path)
+
+def make_pathways(map_uuid: str, map_path: Path):
+#===============================================
+    if (db := open_pathways_index(map_uuid)) is not None:
+        db.close()
+
+def make_hierarchy(map_uuid: str, map_path: Path):
+#=================================================
+    AnatomicalHierarchy().save_hierarchy(map_uuid)
+
+def make_tile_indexes(map_uuid: str, map_path: Path):
+#====================================================
+    for mbtiles in map_path.glob('*.mbtiles'):
+        TileDatabase(map_uuid, mbtiles.stem).close()
+
+def make_compressed_files(map_uuid: str, map_path: Path):
+#========================================================
+    map_id = metadata_cache.json_file(map_path / 'index.json').get('id')
+    for filename in COMPRESSED_MAP_FILES + [f'{map_id}.svg', f'images/{map_id}.svg']:
+        if (map_path / filename).exists():
+            gzip_sidecar(map_path / filename)
+    gzip_sidecar(Path(settings['FLATMAP_ROOT']) / CACHED_SPARC_HIERARCHY)
+
+"""
+The steps to make derived files, in the order they are run
+"""
+PRECOMPUTE_STEPS: list[tuple[str, Callable[[str, Path], None]]] = [
+    ('annotation-sections', make_annotation_sections),
+    ('pathways', make_pathways),
+    ('hierarchy', make_hierarchy),
+    ('tile-indexes', make_tile_indexes),
+    ('compressed-files', make_compressed_files),
+]
+
+#===============================================================================
+
+def precompute_map(map_uuid: str) -> dict[str, float|str]:
+#=========================================================
+    """
+    Make all the derived files of a map, returning how long, in seconds, each
+    step took or the error that stopped the step.
+    """
+    map_path = Path(settings['FLATMAP_ROOT']) / map_uuid
+    timings: dict[str, float|str] = {}
+    for (name, step) in PRECOMPUTE_STEPS:
+        start_time = time.perf_counter()
+        try:
+            step(map_uuid, map_path)
+            timings[name] = round(time.perf_counter() - start_time, 3)
+        except Exception as err:
+            timings[name] = f'Failed: {err}'
+    return timings
+
+def timings_report(map_uuid: str, timings: dict[str, float|str]) -> str:
+#=======================================================================
+    steps = ', '.join(f'{name}: {timing}s' if isinstance(timing, float) else f'{name}: {timing}'
+                        for (name, timing) in timings.items())
+    return f'Precomputed {map_uuid}: {steps}'
+
+#===============================================================================
+
+class Precomputer:
+    """
+    Make the derived files of maps in a pool of background processes.
+    """
+    def __init__(self, max_processes: int):
+        self.__max_processes = max(1, max_processes)
+        self.__executor: Optional[ProcessPoolExecutor] = None
+        self.__lock = threading.Lock()
+
+    def submit(self, map_uuid: str, logger: Optional[logging.Logger]=None) -> Future:
+    #================================================================================
+        with self.__lock:
+            if self.__executor is None:
+                # Spawn rather than fork as the server's process has many threads
+                self.__executor = ProcessPoolExecutor(self.__max_processes,
+                                                      mp_context=multiprocessing.get_context('spawn'),
+                                                      initializer=initialise_logging)
+            future = self.__executor.submit(precompute_map, map_uuid)
+        if logger is not None:
+            def log_timings(future: Future):
+                try:
+                    logger.info(timings_report(map_uuid, future.result()))
+                except Exception as err:
+                    logger.error(f'Cannot precompute {map_uuid}: {err}')
+            future.add_done_callback(log_timings)
+        return future
+
+    def shutdown(self):
+    #==================
+        with self.__lock:
+            if self.__executor is not None:
+                self.__executor.shutdown(wait=False, cancel_futures=True)
+                self.__executor = None
+
+#===============================================================================
+
+precomputer = Precomputer(settings['PRECOMPUTE_PROCESSES'])
+
+#===============================================================================
+
+def main():
+#==========
+    parser = argparse.ArgumentParser(description='Make the files a flatmap server derives from maps')
+    parser.add_argument('--processes', type=int, default=settings['PRECOMPUTE_PROCESSES'],
+                        help=f'Number of maps to process at once. Defaults to {settings["PRECOMPUTE_PROCESSES"]}')
+    parser.add_argument('maps', metavar='MAP', nargs='*',
+                        help='UUIDs of maps to process. Defaults to all maps in FLATMAP_ROOT')
+    args = parser.parse_args()
+
+    initialise_logging()
+    if len(args.maps):
+        map_uuids = [map_uuid.split(':')[-1] for map_uuid in args.maps]
+    else:
+        # Import here as the catalog requires mapmaker
+        from .catalog import flatmap_catalog
+        map_uuids = [Path(flatmap['path']).name for flatmap in flatmap_catalog.flatmaps()]
+    with ProcessPoolExecutor(max(1, args.processes), initializer=initialise_logging) as executor:
+        futures = { executor.submit(precompute_map, map_uuid): map_uuid for map_uuid in map_uuids }
+        for future in as_completed(futures):
+            settings['LOGGER'].info(timings_report(futures[future], future.result()))
+
+#===============================================================================
+
+if __name__ == '__main__':
+#=========================
+    main()
+
+#===============================================================================
+#===============================================================================
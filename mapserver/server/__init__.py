@@ -38,9 +38,13 @@ from litestar.types import GetLogger
 
 from ..competency import COMPETENCY_USER, competency_connection_context, initialise_query_definitions
 from ..competency.manager import initialise_competency_update, terminate_competency_update
-from ..knowledge import KnowledgeStore
+from ..knowledge import KnowledgeStore, knowledge_query_cache, knowledge_stores
 from ..openapi import RapidocRenderPlugin
+from ..pmtiles import pmtiles_archives
+from ..precompute import precomputer
 from ..settings import settings
+from ..tiles import tile_cache, tile_databases
+from ..utils import metadata_cache
 from .. import __version__
 
 from .annotator import annotator_router
@@ -48,6 +52,7 @@ from .competency import competency_router
 from .connectivity import connectivity_router
 from .dashboard import dashboard_router
 from .flatmap import flatmap_router
+from .io_pools import io_pool_statistics, shutdown_io_pools
 from .knowledge import knowledge_router
 from .maker import maker_router, initialise as init_maker, terminate as end_maker
 from .viewer import viewer_router
@@ -100,6 +105,11 @@ def initialise(app: Litestar):
 def terminate(app: Litestar):
     end_maker()
     terminate_competency_update()
+    shutdown_io_pools()
+    precomputer.shutdown()
+    knowledge_stores.close()
+    tile_databases.close()
+    pmtiles_archives.clear()
     settings['LOGGER'].info(f'Shutdown flatmap server...')
 
 #===============================================================================
@@ -130,6 +140,21 @@ async def version() -> list[dict]:
 
 #===============================================================================
 
+@get('/statistics')
+async def statistics() -> dict[str, dict]:
+    """
+    Return usage statistics of the caches held by the worker process
+    which handles the request.
+    """
+    return {
+        'tile-cache': tile_cache.statistics(),
+        'metadata-cache': metadata_cache.statistics(),
+        'knowledge-query-cache': knowledge_query_cache.statistics(),
+        'io-pools': io_pool_statistics(),
+    }
+
+#===============================================================================
+
 route_handlers = [
     annotator_router,
     competency_router,
@@ -138,6 +163,7 @@ route_handlers = [
     flatmap_router,
     knowledge_router,
     maker_router,
+    statistics,
     version
 ]
 
@@ -147,7 +173,7 @@ app = Litestar(
         allow_origins=["*"],
         allow_methods=["GET", "OPTIONS"],
         # MapLibre needs to inspect Content-Range headers when getting PMTiles
-        expose_headers=["Content-Range", "Content-Length", "Accept-Ranges"]
+        expose_headers=["Content-Range", "Content-Length", "Accept-Ranges", "Tile-Encoding", "Link"]
     ),
     openapi_config=OpenAPIConfig(
         title="Flatmap Server Web API",
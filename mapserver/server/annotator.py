@@ -24,7 +24,7 @@ from datetime import datetime, timezone
 import json
 import pathlib
 import sqlite3
-from typing import Any, Optional
+from typing import Any, Callable, Optional, TypeVar
 import uuid
 
 #===============================================================================
@@ -37,6 +37,7 @@ from litestar.middleware.session.server_side import ServerSideSessionConfig
 if __name__ != '__main__':
     from ..pennsieve import get_user as get_pennsieve_user
     from ..settings import settings
+    from .io_pools import sql_io
 else:
     settings = {}
 
@@ -320,6 +321,23 @@ class AnnotationStore:
 
 #===============================================================================
 
+T = TypeVar('T')
+
+async def annotation_store_call(method: Callable[..., T], *args: Any) -> T:
+#==========================================================================
+    """
+    Call an ``AnnotationStore`` method using a thread from the SQL I/O pool.
+    """
+    def call():
+        annotation_store = AnnotationStore()
+        try:
+            return method(annotation_store, *args)
+        finally:
+            annotation_store.close()
+    return await sql_io.run(call)
+
+#===============================================================================
+
 __sessions: dict[str, dict] = {}
 
 def __session_key(key: str) -> str:
@@ -403,13 +421,11 @@ async def annotator_annotated_items(query: dict[str, Any], request: Request) ->
     if __authenticated_session(query, request):
         if (resource_id := __get_json_parameter(query, 'resource')) is not None:
             user_id = __get_json_parameter(query, 'user')
-            annotation_store = AnnotationStore()
             if user_id is not None:
                 participated = __get_json_parameter(query, 'participated', True)
-                item_ids = annotation_store.user_item_ids(resource_id, user_id, participated)
+                item_ids = await annotation_store_call(AnnotationStore.user_item_ids, resource_id, user_id, participated)
             else:
-                item_ids = annotation_store.annotated_item_ids(resource_id)
-            annotation_store.close()
+                item_ids = await annotation_store_call(AnnotationStore.annotated_item_ids, resource_id)
             return item_ids
         return {}
     raise exceptions.NotAuthorizedException()
@@ -420,14 +436,12 @@ async def annotator_annotated_items(query: dict[str, Any], request: Request) ->
 async def annotator_features(query: dict[str, Any], request: Request) -> dict:
     if __authenticated_session(query, request):
         if (resource_id := __get_json_parameter(query, 'resource')) is not None:
-            annotation_store = AnnotationStore()
             if (item_ids := __get_json_parameter(query, 'items')) is not None:
                 if isinstance(item_ids, str):
                     item_ids = [item_ids]
-                features = annotation_store.item_features(resource_id, item_ids)
+                features = await annotation_store_call(AnnotationStore.item_features, resource_id, item_ids)
             else:
-                features = annotation_store.features(resource_id)
-            annotation_store.close()
+                features = await annotation_store_call(AnnotationStore.features, resource_id)
             return features
         return {}
     raise exceptions.NotAuthorizedException()
@@ -439,9 +453,7 @@ async def annotator_annotations(query: dict[str, Any], request: Request) -> list
     if __authenticated_session(query, request):
         if ((resource_id := __get_json_parameter(query, 'resource')) is not None
         and (item_id := __get_json_parameter(query, 'item')) is not None):
-            annotation_store = AnnotationStore()
-            annotations = annotation_store.annotations(resource_id, item_id)
-            annotation_store.close()
+            annotations = await annotation_store_call(AnnotationStore.annotations, resource_id, item_id)
             return annotations
         return []
     raise exceptions.NotAuthorizedException()
@@ -452,9 +464,7 @@ async def annotator_annotations(query: dict[str, Any], request: Request) -> list
 async def annotator_annotation(query: dict[str, Any], request: Request, id: Optional[str]=None) -> dict:
     if __authenticated_session(query, request):
         annotation_id = __get_json_parameter(query, 'annotation', '') if id is None else id
-        annotation_store = AnnotationStore()
-        annotation = annotation_store.annotation(annotation_id)
-        annotation_store.close()
+        annotation = await annotation_store_call(AnnotationStore.annotation, annotation_id)
         return annotation
     raise exceptions.NotAuthorizedException()
 
@@ -472,9 +482,7 @@ class AnnotationUpdateRequest:
 async def annotator_add_annotation(data: AnnotationUpdateRequest, request: Request) -> dict|Response:
     if __authenticated_session(dataclasses.asdict(data), request):
         if request.session['update']:
-            annotation_store = AnnotationStore()
-            result = annotation_store.add_annotation(data.data)
-            annotation_store.close()
+            result = await annotation_store_call(AnnotationStore.add_annotation, data.data)
         else:
             result = Response(content={'error': 'forbidden'}, status_code=403)
         return result
@@ -486,14 +494,12 @@ async def annotator_add_annotation(data: AnnotationUpdateRequest, request: Reque
 async def annotator_update_status(data: AnnotationUpdateRequest, request: Request) -> dict|Response:
     if __authenticated_session(dataclasses.asdict(data), request) or __authenticated_bearer(request):
         if request.session['update']:
-            annotation_store = AnnotationStore()
             annotation_id = data.data.get('annotationId')
             status = data.data.get('status')
             if annotation_id is not None and status is not None:
-                result = annotation_store.update_status(annotation_id, status)
+                result = await annotation_store_call(AnnotationStore.update_status, annotation_id, status)
             else:
                 result = Response(content={'error': 'invalid parameters'}, status_code=400)
-            annotation_store.close()
         else:
             result = Response(content={'error': 'forbidden'}, status_code=403)
         return result
@@ -504,9 +510,7 @@ async def annotator_update_status(data: AnnotationUpdateRequest, request: Reques
 @get('download/')
 async def annotator_download(request: Request)  -> list[dict]:
     if __authenticated_bearer(request):
-        annotation_store = AnnotationStore()
-        annotations = annotation_store.annotations()
-        annotation_store.close()
+        annotations = await annotation_store_call(AnnotationStore.annotations)
         return annotations
     raise exceptions.NotAuthorizedException()
 
@@ -18,32 +18,41 @@
 #
 #===============================================================================
 
+from collections.abc import Iterator
 import gzip
 import io
 import json
+import math
 import pathlib
-import sqlite3
-from typing import Any
+import struct
+from typing import Any, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+import uuid
 
 #===============================================================================
 
-from landez.sources import MBTilesReader, ExtractionError, InvalidFormatError
-
 from litestar import get, MediaType, Request, Response, Router
-from litestar.exceptions import HTTPException, NotFoundException
-from litestar.response import File
+from litestar.exceptions import HTTPException, NotFoundException, ValidationException
+from litestar.params import Parameter
+from litestar.response import File, Stream
 from litestar.status_codes import HTTP_206_PARTIAL_CONTENT, HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
 
 from PIL import Image
 
 #===============================================================================
 
-from ..knowledge.hierarchy import AnatomicalHierarchy
+from ..catalog import flatmap_catalog
+from ..knowledge.hierarchy import AnatomicalHierarchy, CACHED_MAP_HIERARCHY
+from ..pathways import get_paths, paths_through
+from ..pmtiles import PMTILES_CHUNK_SIZE, PMTILES_COMPRESSION_GZIP, PMTILES_TILE_MEDIA_TYPES, PMTILES_TILE_TYPE_MVT
+from ..pmtiles import PMTilesArchive, pmtiles_archives
 from ..settings import settings
-from ..utils import get_metadata, json_map_metadata
+from ..tiles import TileDatabase, tile_databases
+from ..utils import json_map_metadata, json_map_metadata_bytes, metadata_cache
 
+from .io_pools import json_io, sql_io, tile_io
 from .knowledge import query_knowledge
-from .utils import get_flatmap_list
+from .utils import accepts_encoding, CacheValidator, file_response, get_flatmap_list
 
 #===============================================================================
 
@@ -60,137 +69,196 @@ FLATMAP_PATH_PREFIX = 'flatmap'
 #===============================================================================
 #===============================================================================
 
-PATHWAYS_CACHE = 'pathways.json'
-
-def pathways(map_uuid: str) -> dict[str, Any]:
-#=============================================
-    pathways_file = pathlib.Path(settings['FLATMAP_ROOT']) / map_uuid / PATHWAYS_CACHE
-    try:
-        with open(pathways_file) as fp:
-            return json.load(fp)
-    except Exception:
-        pass
-    pathways = json_map_metadata(map_uuid, 'pathways')
-    with open(pathways_file, 'w') as fp:
-        json.dump(pathways, fp)
-    return pathways
-
-#===============================================================================
-#===============================================================================
-
 def blank_tile():
     tile = Image.new('RGBA', (1, 1), color=(255, 255, 255, 0))
     file = io.BytesIO()
     tile.save(file, 'png')
     return file.getvalue()
 
+# Missing image tiles are all the same
+BLANK_TILE = blank_tile()
+
 #===============================================================================
 #===============================================================================
 
 @get('/')
-async def flatmap_maps(request: Request) -> list:
+async def flatmap_maps(request: Request, taxon: Optional[str]=None, sex: Optional[str]=None,
+                       style: Optional[str]=None, latest: bool=False,
+                       created_after: Optional[str]=Parameter(query='created-after', default=None),
+                       fields: Optional[str]=None, limit: Optional[int]=Parameter(default=None, ge=1),
+                       cursor: Optional[str]=None) -> Response:
     """
     Get a list of available flatmaps.
 
+    :query taxon: only list maps of this taxon
+    :query sex: only list maps of this biological sex
+    :query style: only list maps of this style
+    :query latest: if ``true``, only list the most recent map of each taxon and sex
+    :query created-after: only list maps created after this time
+    :query fields: a comma separated list of the fields to return for each map
+    :query limit: the maximum number of maps to list. A ``Link`` header gives the
+                  URL of the next maps, if there are any more
+    :query cursor: where to continue a limited listing from
+
     :>jsonarr string id: the flatmap's unique identifier on the server
     :>jsonarr string source: the map's source URL
     :>jsonarr string created: when the map was generated
     :>jsonarr string describes: the map's description
     """
-    flatmap_list = get_flatmap_list()
-    for flatmap in flatmap_list:
+    headers = {}
+    if (taxon is None and sex is None and style is None and not latest
+    and created_after is None and limit is None and cursor is None):
+        flatmap_list = await json_io.run(get_flatmap_list)
+    else:
+        try:
+            (flatmap_list, next_cursor) = await json_io.run(flatmap_catalog.query, taxon, sex, style,
+                                                            created_after, latest, limit, cursor)
+        except ValueError as err:
+            raise ValidationException(detail=str(err))
+        if next_cursor is not None:
+            url = urlsplit(str(request.url))
+            query = [(key, value) for (key, value) in parse_qsl(url.query) if key != 'cursor']
+            query.append(('cursor', next_cursor))
+            headers['Link'] = f'<{urlunsplit(url._replace(query=urlencode(query)))}>; rel="next"'
+    field_names = None if fields is None else [name.strip() for name in fields.split(',')]
+    for (n, flatmap) in enumerate(flatmap_list):
         if 'error' in flatmap:
             request.logger.error(flatmap['error'])
         else:
             id = flatmap.get('uuid', flatmap['id'])
             flatmap['uri'] = f'{request.base_url}{FLATMAP_PATH_PREFIX}/{id}/'
-    return flatmap_list
+        if field_names is not None:
+            flatmap_list[n] = { name: flatmap[name] for name in field_names if name in flatmap }
+    return Response(content=flatmap_list, headers=headers)
 
 #===============================================================================
 
-@get('flatmap/{map_uuid:str}/')
-async def flatmap_index(request: Request, map_uuid: str) -> dict|Response:
-    """
-    Return a representation of a flatmap.
+def json_bytes_response(content: bytes, gzipped: bool, validator: CacheValidator) -> Response:
+#============================================================================================
+    headers = validator.headers
+    if gzipped:
+        headers['Content-Encoding'] = 'gzip'
+    return Response(content=content, media_type=MediaType.JSON, headers=headers)
 
-    :param map_uuid: The flatmap identifier
-    :type map_uuid: string
-
-    :reqheader Accept: Determines the response content
+#===============================================================================
 
-    A request for ``text/turtle`` will return the RDF knowledge about the map in
-    ``index.ttl`; if an SVG representation of the map exists and the :mailheader:`Accept`
-    header doesn't specify a JSON response then the SVG is returned; otherwise the
-    flatmap's ``index.json`` is returned.
-    """
+def map_index_response(request: Request, map_uuid: str) -> Response:
+#===================================================================
     index_file = pathlib.Path(settings['FLATMAP_ROOT']) / map_uuid / 'index.json'
     if not index_file.exists():
         return Response(content={'detail': 'Missing map index'}, status_code=404)
-    with open(index_file) as fp:
-        index = json.load(fp)
+    index = metadata_cache.json_file(index_file)
     accept_mediatype = request.headers.get('accept', '*/*')
     if 'text/turtle' in accept_mediatype:
         # Return RDF knowledge (as Turtle) about the map.
         knowledge = pathlib.Path(settings['FLATMAP_ROOT']) / map_uuid / 'index.ttl'
         if not knowledge.exists():
             return Response(content={'detail': 'RDF knowledge is not available'}, status_code=404)
+        validator = CacheValidator.for_map_files(map_uuid, 'index.ttl', vary='Accept')
+        if validator.matches(request):
+            return validator.not_modified()
         with open(knowledge) as fp:
-            return Response(content=fp.read(), media_type='text/turtle')
+            return Response(content=fp.read(), media_type='text/turtle', headers=validator.headers)
     elif 'json' not in request.headers.get('accept', '*/*'):
-        svg_file = pathlib.Path(settings['FLATMAP_ROOT']) / map_uuid / f'{index["id"]}.svg'
+        svg_name = f'{index["id"]}.svg'
+        svg_file = pathlib.Path(settings['FLATMAP_ROOT']) / map_uuid / svg_name
         if not svg_file.exists():
-            svg_file = pathlib.Path(settings['FLATMAP_ROOT']) / map_uuid / 'images' / f'{index["id"]}.svg'
+            svg_name = f'images/{index["id"]}.svg'
+            svg_file = pathlib.Path(settings['FLATMAP_ROOT']) / map_uuid / svg_name
         if svg_file.exists():
-            with open(svg_file) as fp:
-                return Response(content=fp.read(), media_type='image/svg+xml')
-    return index
+            gzipped = accepts_encoding(request, 'gzip')
+            validator = CacheValidator.for_map_files(map_uuid, svg_name, variant='gzip' if gzipped else '',
+                                                     vary='Accept, Accept-Encoding')
+            if validator.matches(request):
+                return validator.not_modified()
+            return file_response(request, svg_file, 'image/svg+xml', validator, content_disposition_type='inline')
+    gzipped = accepts_encoding(request, 'gzip')
+    validator = CacheValidator.for_map_files(map_uuid, 'index.json', variant='gzip' if gzipped else '',
+                                             vary='Accept, Accept-Encoding')
+    if validator.matches(request):
+        return validator.not_modified()
+    return json_bytes_response(metadata_cache.json_bytes(index_file, 'index', index_file.read_bytes, gzipped),
+                               gzipped, validator)
+
+@get('flatmap/{map_uuid:str}/')
+async def flatmap_index(request: Request, map_uuid: str) -> Response:
+    """
+    Return a representation of a flatmap.
+
+    :param map_uuid: The flatmap identifier
+    :type map_uuid: string
+
+    :reqheader Accept: Determines the response content
+
+    A request for ``text/turtle`` will return the RDF knowledge about the map in
+    ``index.ttl`; if an SVG representation of the map exists and the :mailheader:`Accept`
+    header doesn't specify a JSON response then the SVG is returned; otherwise the
+    flatmap's ``index.json`` is returned.
+    """
+    return await json_io.run(map_index_response, request, map_uuid)
 
 #===============================================================================
 
 @get('flatmap/{map_uuid:str}/log')
-async def flatmap_maker_log(map_uuid: str) -> File:
+async def flatmap_maker_log(request: Request, map_uuid: str) -> File|Response:
     path = pathlib.Path(settings['FLATMAP_ROOT']) / map_uuid / MAKER_LOG
     if not path.exists():
         path = pathlib.Path(settings['FLATMAP_ROOT']) / map_uuid / OLD_MAKER_LOG
         if not path.exists():
             raise NotFoundException(detail=f'Missing {MAKER_LOG}')
         return File(path=path, filename=OLD_MAKER_LOG, media_type=MediaType.TEXT)
-    return File(path=path, filename=MAKER_LOG, media_type=MediaType.JSON)
+    return await json_io.run(file_response, request, path, MediaType.JSON, None, filename=MAKER_LOG)
 
 #===============================================================================
 
 @get('flatmap/{map_uuid:str}/style')
-async def flatmap_style(map_uuid: str) -> File:
+async def flatmap_style(request: Request, map_uuid: str) -> File|Response:
     path = pathlib.Path(settings['FLATMAP_ROOT']) / map_uuid / 'style.json'
-    return File(path=path, media_type=MediaType.JSON)
+    gzipped = accepts_encoding(request, 'gzip')
+    validator = CacheValidator.for_map_files(map_uuid, 'style.json', variant='gzip' if gzipped else '',
+                                             vary='Accept-Encoding')
+    if validator.matches(request):
+        return validator.not_modified()
+    return await json_io.run(file_response, request, path, MediaType.JSON, validator)
 
 #===============================================================================
 
-@get('flatmap/{map_uuid:str}/layers')
-async def flatmap_layers(map_uuid: str) -> dict:
+"""
+Files in a map's directory which its metadata is obtained from
+"""
+MAP_METADATA_FILES = ('index.json', 'annotations.json', 'index.mbtiles')
+
+def map_metadata_response(request: Request, map_uuid: str, name: str) -> Response:
+#=================================================================================
+    """
+    A section of a map's metadata, sent as already serialised JSON.
+    """
+    gzipped = accepts_encoding(request, 'gzip')
+    validator = CacheValidator.for_map_files(map_uuid, *MAP_METADATA_FILES, variant='gzip' if gzipped else '',
+                                             vary='Accept-Encoding')
+    if validator.matches(request):
+        return validator.not_modified()
     try:
-        return json_map_metadata(map_uuid, 'layers')
+        return json_bytes_response(json_map_metadata_bytes(map_uuid, name, gzipped), gzipped, validator)
     except IOError as err:
         raise NotFoundException(detail=str(err))
 
+@get('flatmap/{map_uuid:str}/layers')
+async def flatmap_layers(request: Request, map_uuid: str) -> Response:
+    return await json_io.run(map_metadata_response, request, map_uuid, 'layers')
+
 #===============================================================================
 
 @get('flatmap/{map_uuid:str}/metadata')
-async def flatmap_metadata(map_uuid: str) -> dict:
-    try:
-        return json_map_metadata(map_uuid, 'metadata')
-    except IOError as err:
-        raise NotFoundException(detail=str(err))
+async def flatmap_metadata(request: Request, map_uuid: str) -> Response:
+    return await json_io.run(map_metadata_response, request, map_uuid, 'metadata')
 
 #===============================================================================
 #===============================================================================
 
 @get('flatmap/{map_uuid:str}/pathways')
-async def flatmap_pathways(map_uuid: str) -> dict:
-    try:
-        return pathways(map_uuid)
-    except IOError as err:
-        raise NotFoundException(detail=str(err))
+async def flatmap_pathways(request: Request, map_uuid: str) -> Response:
+    return await json_io.run(map_metadata_response, request, map_uuid, 'pathways')
 
 #===============================================================================
 
@@ -208,15 +276,77 @@ CONNECTIVITY_PROPERTIES = [
 @get('flatmap/{map_uuid:str}/connectivity/{path_id:path}')
 async def flatmap_connectivity(map_uuid: str, path_id: str) -> dict:
     path_id = path_id[1:]       # Remove leading '/''
+    if not path_id.startswith('ilxtr:'):
+        raise NotFoundException(detail=f'Unknown path: {path_id}')
     try:
-        path_data = pathways(map_uuid)
+        paths = await json_io.run(get_paths, map_uuid, [path_id])
     except IOError as err:
         raise NotFoundException(detail=str(err))
-    paths = path_data.get('paths', {})
-    if not path_id.startswith('ilxtr:') or path_id not in paths:
+    if (path := paths.get(path_id)) is None:
         raise NotFoundException(detail=f'Unknown path: {path_id}')
-    path = paths[path_id]
-    connectivity = {
+    connectivity = path_connectivity(path_id, path)
+    metadata = await json_io.run(json_map_metadata, map_uuid, 'metadata')
+    source = metadata.get('connectivity', {}).get('knowledge-source')
+    if source is not None:
+        result = await sql_io.run(query_knowledge, 'select knowledge from knowledge where source=? and entity=?',
+                                  [source, path_id])
+        if 'error' in result:
+            connectivity['error'] = result['error']
+        else:
+            add_path_knowledge(connectivity, result['values'][0][0])
+    return connectivity
+
+# Limit the number of paths in a batch request
+MAX_BATCH_PATHS = 1000
+
+@get('flatmap/{map_uuid:str}/connectivity')
+async def flatmap_connectivity_batch(map_uuid: str, paths: Optional[str]=None,
+                                     feature: Optional[str]=None) -> dict:
+    """
+    Get the connectivity of several of a map's paths.
+
+    :query paths: a comma separated list of path ids
+    :query feature: include all paths which pass through this feature
+
+    :>json object paths: the connectivity of each path found, keyed by path id,
+                         as returned for a single path
+    :>json array(string) unknown: requested path ids which aren't paths of the map
+    :>json string error: set if path knowledge couldn't be obtained
+    """
+    path_ids = [] if paths is None else [path_id.strip() for path_id in paths.split(',') if path_id.strip()]
+    try:
+        if feature is not None:
+            path_ids.extend(await json_io.run(paths_through, map_uuid, feature))
+        path_ids = list(dict.fromkeys(path_ids))
+        if len(path_ids) == 0:
+            raise ValidationException(detail='No paths specified')
+        elif len(path_ids) > MAX_BATCH_PATHS:
+            raise ValidationException(detail=f'Too many paths, maximum is {MAX_BATCH_PATHS}')
+        path_data = await json_io.run(get_paths, map_uuid, [path_id for path_id in path_ids
+                                                                if path_id.startswith('ilxtr:')])
+        metadata = await json_io.run(json_map_metadata, map_uuid, 'metadata')
+    except IOError as err:
+        raise NotFoundException(detail=str(err))
+    response: dict[str, Any] = {
+        'paths': { path_id: path_connectivity(path_id, path) for (path_id, path) in path_data.items() },
+        'unknown': [path_id for path_id in path_ids if path_id not in path_data]
+    }
+    source = metadata.get('connectivity', {}).get('knowledge-source')
+    if source is not None and len(path_data):
+        result = await sql_io.run(query_knowledge,
+            f'select entity, knowledge from knowledge where source=? and entity in ({",".join(len(path_data)*"?")})',
+            [source, *path_data.keys()])
+        if 'error' in result:
+            response['error'] = result['error']
+        else:
+            for (path_id, knowledge) in result['values']:
+                if (connectivity := response['paths'].get(path_id)) is not None:
+                    add_path_knowledge(connectivity, knowledge)
+    return response
+
+def path_connectivity(path_id: str, path: dict[str, Any]) -> dict[str, Any]:
+#==========================================================================
+    return {
         'id': path_id,
         'connectivity': path.get('connectivity', []),
         'node-phenotypes': path.get('node-phenotypes', {}),
@@ -225,121 +355,352 @@ async def flatmap_connectivity(map_uuid: str, path_id: str) -> dict:
         'dendrites': path.get('dendrites', []),
         'somas': path.get('somas', []),
     }
-    metadata = json_map_metadata(map_uuid, 'metadata')
-    source = metadata.get('connectivity', {}).get('knowledge-source')
-    if source is not None:
-        result = query_knowledge('select knowledge from knowledge where source=? and entity=?', [source, path_id])
-        if 'error' in result:
-            connectivity['error'] = result['error']
-        else:
-            knowledge = json.loads(result['values'][0][0])
-            for key in CONNECTIVITY_PROPERTIES:
-                if key in knowledge:
-                    connectivity[key] = knowledge[key]
-    return connectivity
+
+def add_path_knowledge(connectivity: dict[str, Any], knowledge: str):
+#===================================================================
+    path_knowledge = json.loads(knowledge)
+    for key in CONNECTIVITY_PROPERTIES:
+        if key in path_knowledge:
+            connectivity[key] = path_knowledge[key]
 
 #===============================================================================
 #===============================================================================
 
 @get('flatmap/{map_uuid:str}/images/{image:str}')
-async def flatmap_image(map_uuid: str, image:str) -> Response:
+async def flatmap_image(request: Request, map_uuid: str, image:str) -> Response:
     path = pathlib.Path(settings['FLATMAP_ROOT']) / map_uuid / 'images' / image
     if not path.exists():
         raise NotFoundException(detail=f'Missing image: {image}')
-    return File(path=path, filename=image, content_disposition_type='inline')
+    validator = CacheValidator.for_map_files(map_uuid, f'images/{image}')
+    if validator.matches(request):
+        return validator.not_modified()
+    return File(path=path, filename=image, content_disposition_type='inline', headers=validator.headers)
 
 #===============================================================================
 
-@get('flatmap/{map_uuid:str}/mvtiles/{z:int}/{x:int}/{y:int}')
-async def flatmap_vector_tiles(map_uuid: str, z: int, y:int, x: int) -> Response:
+def tile_validator(tile_database: TileDatabase, z: int, x: int, y: int, encoding: str='') -> CacheValidator:
+#=========================================================================================================
+    return CacheValidator(tile_database.path, tile_database.signature, z, x, y, encoding,
+                          modified=tile_database.signature[1]/1e9,
+                          vary='Accept-Encoding' if tile_database.compressed else None)
+
+def vector_tile_response(request: Request, map_uuid: str, z: int, x: int, y: int) -> Response:
+#=============================================================================================
     try:
-        mbtiles = pathlib.Path(settings['FLATMAP_ROOT']) / map_uuid / 'index.mbtiles'
-        tile_reader = MBTilesReader(mbtiles)
-        tile_bytes = tile_reader.tile(z, x, y)
-        if get_metadata(tile_reader, 'compressed'):
-            tile_bytes = gzip.decompress(tile_bytes)
-        return Response(content=tile_bytes, media_type='application/octet-stream')
-    except ExtractionError:
-        pass
-    except (InvalidFormatError, sqlite3.OperationalError):
-        raise NotFoundException(detail='Cannot read tile database')
-    return Response(content='', status_code=204)
-
-#===============================================================================
-
-def parse_range_header(header_value: str, file_size: int) -> tuple[int, int]:
-    """Parses a standard 'bytes=start-end' Range header."""
+        tile_database = tile_databases.get(map_uuid, 'index')
+        send_gzipped = tile_database.compressed and accepts_encoding(request, 'gzip')
+        validator = tile_validator(tile_database, z, x, y, 'gzip' if send_gzipped else '')
+        if validator.matches(request):
+            return validator.not_modified()
+        tile_bytes = tile_database.tile(z, x, y)
+    except IOError as err:
+        raise NotFoundException(detail=str(err))
+    if tile_bytes is None:
+        return Response(content='', status_code=204)
+    headers = validator.headers
+    if send_gzipped:
+        headers['Content-Encoding'] = 'gzip'
+    elif tile_database.compressed:
+        tile_bytes = gzip.decompress(tile_bytes)
+    return Response(content=tile_bytes, media_type='application/octet-stream', headers=headers)
+
+@get('flatmap/{map_uuid:str}/mvtiles/{z:int}/{x:int}/{y:int}')
+async def flatmap_vector_tiles(request: Request, map_uuid: str, z: int, y:int, x: int) -> Response:
+    """
+    Get a vector tile.
+
+    Tiles that are stored compressed are sent as is, with a ``gzip``
+    :mailheader:`Content-Encoding`, when the client accepts this encoding.
+    """
+    return await tile_io.run(vector_tile_response, request, map_uuid, z, x, y)
+
+#===============================================================================
+
+# Limit the number of ranges in a request
+MAX_BYTE_RANGES = 64
+
+PMTILES_MEDIA_TYPE = 'application/vnd.pmtiles'
+
+def parse_range_header(header_value: str, file_size: int) -> list[tuple[int, int]]:
+    """
+    Parses a standard 'bytes=start-end, ...' Range header.
+
+    Open ended (``start-``) and suffix (``-length``) ranges are allowed. The
+    satisfiable ranges are returned in order, with overlapping and adjacent
+    ranges merged.
+    """
+    ranges = []
     try:
-        # Expected format: "bytes=0-1023"
-        units, ranges = header_value.strip().split("=")
-        if units != "bytes":
+        # Expected format: "bytes=0-1023, 4096-, -512"
+        units, range_set = header_value.strip().split("=", 1)
+        if units.strip().lower() != "bytes":
             raise ValueError
-        start_str, end_str = ranges.split("-")
-        start = int(start_str) if start_str else 0
-        end = int(end_str) if end_str else file_size - 1
-        if start >= file_size or end >= file_size or start > end:
+        range_specs = [spec.strip() for spec in range_set.split(",") if spec.strip()]
+        if len(range_specs) == 0 or len(range_specs) > MAX_BYTE_RANGES:
             raise ValueError
-        return start, end
+        for range_spec in range_specs:
+            start_str, end_str = range_spec.split("-")
+            if start_str:
+                start = int(start_str)
+                end = int(end_str) if end_str else file_size - 1
+                if end < start:
+                    raise ValueError
+                end = min(end, file_size - 1)
+            else:
+                suffix_length = int(end_str)
+                start = max(0, file_size - suffix_length)
+                end = file_size - 1 if suffix_length > 0 else -1
+            if start < 0:
+                raise ValueError
+            if start < file_size and start <= end:
+                ranges.append((start, end))
     except ValueError:
-        raise HTTPException(status_code=HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        raise HTTPException(status_code=HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                            headers={"Content-Range": f"bytes */{file_size}"})
+    if len(ranges) == 0:
+        raise HTTPException(status_code=HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                            headers={"Content-Range": f"bytes */{file_size}"})
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        if start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+def multipart_byteranges(archive: PMTilesArchive, ranges: list[tuple[int, int]],
+                         boundary: str) -> tuple[int, Iterator[bytes]]:
+    """
+    The length and content of a ``multipart/byteranges`` response body.
+    """
+    part_headers = [(f'--{boundary}\r\n'
+                     f'Content-Type: {PMTILES_MEDIA_TYPE}\r\n'
+                     f'Content-Range: bytes {start}-{end}/{archive.size}\r\n'
+                     '\r\n').encode() for start, end in ranges]
+    closing = f'--{boundary}--\r\n'.encode()
+    length = (sum(len(header) + (end - start + 1) + 2 for header, (start, end) in zip(part_headers, ranges))
+              + len(closing))
+    def body():
+        for header, (start, end) in zip(part_headers, ranges):
+            yield header
+            yield from archive.stream(start, end)
+            yield b'\r\n'
+        yield closing
+    return (length, body())
 
 @get([
     "flatmap/{map_uuid:str}/pmtiles/",
     "flatmap/{map_uuid:str}/pmtiles/{layer:str}"
 ])
-async def flatmap_get_pmtiles(request: Request, map_uuid: str, layer: str='index') -> File:
+async def flatmap_get_pmtiles(request: Request, map_uuid: str, layer: str='index') -> Response:
+    """
+    Get a map's PMTiles archive.
+
+    :reqheader Range: One or more byte ranges of the archive to return. Multiple
+                      ranges are returned as ``multipart/byteranges``
+    """
     filename = f'{layer}.pmtiles'
     filepath = pathlib.Path(settings['FLATMAP_ROOT']) / map_uuid / filename
     if not filepath.exists():
         raise NotFoundException(detail='Missing file')
-    file_size = filepath.stat().st_size
     range_header = request.headers.get("range")
     if not range_header:
-        # Return the entire file
-        return Response(
-            content=filepath.read_bytes(),
-            media_type='application/vnd.pmtiles',
+        # Return the entire file, streamed from disk
+        return File(
+            path=filepath,
+            filename=filename,
+            content_disposition_type='inline',
+            media_type=PMTILES_MEDIA_TYPE,
             headers={"Accept-Ranges": "bytes"}
         )
-    # Read and return partial content
-    start, end = parse_range_header(range_header, file_size)
+    # Return partial content from the archive's shared memory map
+    try:
+        archive = await tile_io.run(pmtiles_archives.get, map_uuid, layer)
+    except IOError as err:
+        raise NotFoundException(detail=str(err))
+    file_size = archive.size
+    ranges = parse_range_header(range_header, file_size)
+    if len(ranges) > 1:
+        boundary = uuid.uuid4().hex
+        (length, body) = multipart_byteranges(archive, ranges, boundary)
+        return Stream(
+            body,
+            status_code=HTTP_206_PARTIAL_CONTENT,
+            media_type=f'multipart/byteranges; boundary={boundary}',
+            headers={
+                "Accept-Ranges": "bytes",
+                "Content-Length": str(length),
+            },
+        )
+    start, end = ranges[0]
     requested_length = (end - start) + 1
-    with open(filepath, "rb") as f:
-        f.seek(start)
-        data = f.read(requested_length)
-    return Response(
-        content=data,
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Range": f"bytes {start}-{end}/{file_size}",
+        "Content-Length": str(requested_length),
+    }
+    if requested_length <= PMTILES_CHUNK_SIZE:
+        return Response(
+            content=await tile_io.run(archive.read, start, end),
+            status_code=HTTP_206_PARTIAL_CONTENT,
+            media_type=PMTILES_MEDIA_TYPE,
+            headers=headers,
+        )
+    return Stream(
+        archive.stream(start, end),
         status_code=HTTP_206_PARTIAL_CONTENT,
-        media_type='application/vnd.pmtiles',
-        headers={
-            "Accept-Ranges": "bytes",
-            "Content-Range": f"bytes {start}-{end}/{file_size}",
-            "Content-Length": str(requested_length),
-        },
+        media_type=PMTILES_MEDIA_TYPE,
+        headers=headers,
     )
 
 #===============================================================================
 
-@get('flatmap/{map_uuid:str}/tiles/{layer:str}/{z:int}/{x:int}/{y:int}')
-async def flatmap_image_tiles(map_uuid: str, layer: str, z: int, y:int, x: int) -> Response:
+def pmtiles_tile_response(request: Request, map_uuid: str, layer: str, z: int, x: int, y: int) -> Response:
+#==========================================================================================================
     try:
-        mbtiles = pathlib.Path(settings['FLATMAP_ROOT']) / map_uuid / f'{layer}.mbtiles'
-        reader = MBTilesReader(mbtiles)
-        return Response(content=reader.tile(z, x, y), media_type='image/png')
-    except ExtractionError:
-        pass
-    except (InvalidFormatError, sqlite3.OperationalError):
-        raise NotFoundException(detail='Cannot read tile database')
-    return Response(content=blank_tile(), media_type='image/png')
+        archive = pmtiles_archives.get(map_uuid, layer)
+        header = archive.header
+        compressed = (header.tile_compression == PMTILES_COMPRESSION_GZIP)
+        send_gzipped = compressed and accepts_encoding(request, 'gzip')
+        validator = CacheValidator(archive.path, archive.signature, z, x, y, 'gzip' if send_gzipped else '',
+                                   modified=archive.signature[1]/1e9,
+                                   vary='Accept-Encoding' if compressed else None)
+        if validator.matches(request):
+            return validator.not_modified()
+        tile_bytes = archive.tile(z, x, y)
+    except IOError as err:
+        raise NotFoundException(detail=str(err))
+    media_type = PMTILES_TILE_MEDIA_TYPES.get(header.tile_type, 'application/octet-stream')
+    if tile_bytes is None:
+        if header.tile_type == PMTILES_TILE_TYPE_MVT:
+            return Response(content='', status_code=204)
+        return Response(content=BLANK_TILE, media_type='image/png', headers=validator.headers)
+    headers = validator.headers
+    if send_gzipped:
+        headers['Content-Encoding'] = 'gzip'
+    elif compressed:
+        tile_bytes = gzip.decompress(tile_bytes)
+    return Response(content=tile_bytes, media_type=media_type, headers=headers)
+
+@get('flatmap/{map_uuid:str}/pmtiles/{layer:str}/{z:int}/{x:int}/{y:int}')
+async def flatmap_pmtiles_tile(request: Request, map_uuid: str, layer: str, z: int, y:int, x: int) -> Response:
+    """
+    Get a tile from a map's PMTiles archive.
+
+    Vector tiles are returned as for ``mvtiles`` and missing image tiles as a
+    blank image.
+    """
+    return await tile_io.run(pmtiles_tile_response, request, map_uuid, layer, z, x, y)
 
 #===============================================================================
 
-@get('flatmap/{map_uuid:str}/annotations')
-async def flatmap_annotation(map_uuid: str) -> dict:
+def image_tile_response(request: Request, map_uuid: str, layer: str, z: int, x: int, y: int) -> Response:
+#========================================================================================================
+    try:
+        tile_database = tile_databases.get(map_uuid, layer)
+        validator = tile_validator(tile_database, z, x, y)
+        if validator.matches(request):
+            return validator.not_modified()
+        tile_bytes = tile_database.tile(z, x, y)
+    except IOError as err:
+        raise NotFoundException(detail=str(err))
+    if tile_bytes is None:
+        tile_bytes = BLANK_TILE
+    return Response(content=tile_bytes, media_type='image/png', headers=validator.headers)
+
+@get('flatmap/{map_uuid:str}/tiles/{layer:str}/{z:int}/{x:int}/{y:int}')
+async def flatmap_image_tiles(request: Request, map_uuid: str, layer: str, z: int, y:int, x: int) -> Response:
+    return await tile_io.run(image_tile_response, request, map_uuid, layer, z, x, y)
+
+#===============================================================================
+
+# Limit the number of tiles in a batch request
+MAX_BATCH_TILES = 256
+
+# Each tile in a batch is preceded by its zoom level, column, row and data length
+BATCH_TILE_HEADER = struct.Struct('>BIII')
+
+def lon_lat_tile(lon: float, lat: float, z: int) -> tuple[int, int]:
+#===================================================================
+    scale = 1 << z
+    lat = max(-85.0511287798, min(85.0511287798, lat))
+    x = int((lon + 180.0)/360.0*scale)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat)))/math.pi)/2.0*scale)
+    return (max(0, min(scale - 1, x)), max(0, min(scale - 1, y)))
+
+def batch_tile_positions(tiles: Optional[str], bounds: Optional[str], zoom: Optional[str]) -> dict[int, set[tuple[int, int]]]:
+#===========================================================================================================================
+    positions: dict[int, set[tuple[int, int]]] = {}
+    count = 0
     try:
-        return json_map_metadata(map_uuid, 'annotations')
+        if tiles is not None:
+            for tile in tiles.split(','):
+                (z, x, y) = (int(n) for n in tile.split('/'))
+                if not (0 <= z <= 31 and 0 <= x < (1 << z) and 0 <= y < (1 << z)):
+                    raise ValueError
+                positions.setdefault(z, set()).add((x, y))
+        elif bounds is not None and zoom is not None:
+            (west, south, east, north) = (float(n) for n in bounds.split(','))
+            if not all(math.isfinite(n) for n in (west, south, east, north)):
+                raise ValueError
+            (min_zoom, _, max_zoom) = zoom.partition('-')
+            for z in range(int(min_zoom), int(max_zoom or min_zoom) + 1):
+                if not (0 <= z <= 31):
+                    raise ValueError
+                (min_x, min_y) = lon_lat_tile(west, north, z)
+                (max_x, max_y) = lon_lat_tile(east, south, z)
+                count += (max_x - min_x + 1)*(max_y - min_y + 1)
+                if count > MAX_BATCH_TILES:
+                    break
+                positions[z] = set((x, y) for x in range(min_x, max_x + 1)
+                                          for y in range(min_y, max_y + 1))
+        else:
+            raise ValidationException(detail='Either `tiles` or `bounds` and `zoom` must be given')
+    except ValueError:
+        raise ValidationException(detail='Invalid tile coordinates')
+    if sum(len(xy) for xy in positions.values()) > MAX_BATCH_TILES or count > MAX_BATCH_TILES:
+        raise ValidationException(detail=f'A batch is limited to {MAX_BATCH_TILES} tiles')
+    return positions
+
+@get('flatmap/{map_uuid:str}/tile-batch/{layer:str}')
+async def flatmap_tile_batch(map_uuid: str, layer: str, tiles: Optional[str]=None,
+                             bounds: Optional[str]=None, zoom: Optional[str]=None) -> Stream:
+    """
+    Get a batch of tiles from one of a map's tile layers.
+
+    :param layer: The tile layer, ``index`` for vector tiles
+    :query tiles: A comma separated list of ``z/x/y`` tile coordinates
+    :query bounds: ``west,south,east,north`` longitudes and latitudes of an area to
+                   get tiles for, as an alternative to ``tiles``
+    :query zoom: The zoom level, or ``min-max`` levels, of tiles to get for ``bounds``
+
+    The response is the tiles that exist, each preceded by a 13 byte header of the
+    tile's zoom level (1 byte), column, row and data length (each 4 bytes,
+    big-endian). Tile data is as stored in the map's tile database, with the
+    :mailheader:`Tile-Encoding` header set to ``gzip`` if it is compressed.
+    """
+    positions = batch_tile_positions(tiles, bounds, zoom)
+    def read_tiles():
+        tile_database = tile_databases.get(map_uuid, layer)
+        return (tile_database, [(z, tile_database.tiles(z, xy)) for (z, xy) in sorted(positions.items())])
+    try:
+        (tile_database, batch) = await tile_io.run(read_tiles)
     except IOError as err:
         raise NotFoundException(detail=str(err))
+    def tile_records():
+        for (z, found) in batch:
+            for ((x, y), data) in sorted(found.items(), key=lambda item: (item[0][1], item[0][0])):
+                yield BATCH_TILE_HEADER.pack(z, x, y, len(data))
+                yield data
+    headers = {'Tile-Encoding': 'gzip'} if tile_database.compressed else {}
+    return Stream(tile_records(), media_type='application/octet-stream', headers=headers)
+
+#===============================================================================
+
+@get('flatmap/{map_uuid:str}/annotations')
+async def flatmap_annotation(request: Request, map_uuid: str) -> Response:
+    return await json_io.run(map_metadata_response, request, map_uuid, 'annotations')
 
 #===============================================================================
 
@@ -347,12 +708,23 @@ async def flatmap_annotation(map_uuid: str) -> dict:
 Build and cache a hierarchy of anataomical terms used by a flatmap.
 """
 @get('flatmap/{map_uuid:str}/termgraph')
-async def flatmap_termgraph(map_uuid: str) -> dict:
+async def flatmap_termgraph(request: Request, map_uuid: str) -> dict|File|Response:
     try:
         anatomical_hierarchy = AnatomicalHierarchy()
-        return anatomical_hierarchy.get_hierarchy(map_uuid)
+        hierarchy = await json_io.run(anatomical_hierarchy.save_hierarchy, map_uuid)
     except IOError as err:
         raise NotFoundException(detail=str(err))
+    if hierarchy is not None:
+        # The map's directory isn't writable
+        return hierarchy
+    hierarchy_file = pathlib.Path(settings['FLATMAP_ROOT']) / map_uuid / CACHED_MAP_HIERARCHY
+    gzipped = accepts_encoding(request, 'gzip')
+    validator = CacheValidator.for_map_files(map_uuid, CACHED_MAP_HIERARCHY, variant='gzip' if gzipped else '',
+                                             vary='Accept-Encoding')
+    if validator.matches(request):
+        return validator.not_modified()
+    return await json_io.run(file_response, request, hierarchy_file, MediaType.JSON, validator,
+                             content_disposition_type='inline')
 
 #===============================================================================
 #===============================================================================
@@ -362,6 +734,7 @@ flatmap_router = Router(
     route_handlers=[
         flatmap_annotation,
         flatmap_get_pmtiles,
+        flatmap_pmtiles_tile,
         flatmap_image,
         flatmap_image_tiles,
         flatmap_index,
@@ -371,8 +744,10 @@ flatmap_router = Router(
         flatmap_metadata,
         flatmap_pathways,
         flatmap_connectivity,
+        flatmap_connectivity_batch,
         flatmap_style,
         flatmap_termgraph,
+        flatmap_tile_batch,
         flatmap_vector_tiles
     ]
 )
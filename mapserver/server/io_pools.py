@@ -0,0 +1,108 @@
+#===============================================================================
+#
+#  Flatmap server
+#
+#  Copyright (c) 2019-2025  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+import asyncio
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from typing import Any, TypeVar
+
+#===============================================================================
+
+from ..settings import settings
+
+#===============================================================================
+
+T = TypeVar('T')
+
+class IOPool:
+    """
+    A bounded pool of threads for running a class of blocking I/O calls
+    outside of a worker's event loop.
+    """
+    def __init__(self, name: str, max_threads: int):
+        self.__name = name
+        self.__max_threads = max(1, max_threads)
+        self.__executor = ThreadPoolExecutor(self.__max_threads, thread_name_prefix=f'{name}-io')
+        self.__lock = threading.Lock()
+        self.__queued = 0
+        self.__max_queued = 0
+        self.__running = 0
+        self.__completed = 0
+
+    @property
+    def name(self) -> str:
+        return self.__name
+
+    async def run(self, func: Callable[..., T], *args: Any) -> T:
+    #============================================================
+        """
+        Call ``func(*args)`` in the pool and wait for its result.
+        """
+        with self.__lock:
+            self.__queued += 1
+            if self.__queued > self.__max_queued:
+                self.__max_queued = self.__queued
+        def call():
+            with self.__lock:
+                self.__queued -= 1
+                self.__running += 1
+            try:
+                return func(*args)
+            finally:
+                with self.__lock:
+                    self.__running -= 1
+                    self.__completed += 1
+        return await asyncio.get_running_loop().run_in_executor(self.__executor, call)
+
+    def shutdown(self):
+    #==================
+        self.__executor.shutdown(wait=False, cancel_futures=True)
+
+    def statistics(self) -> dict[str, int]:
+    #======================================
+        with self.__lock:
+            return {
+                'threads': self.__max_threads,
+                'queued': self.__queued,
+                'max-queued': self.__max_queued,
+                'running': self.__running,
+                'completed': self.__completed,
+            }
+
+#===============================================================================
+
+tile_io = IOPool('tiles', settings['TILE_IO_THREADS'])
+json_io = IOPool('json', settings['JSON_IO_THREADS'])
+sql_io = IOPool('sql', settings['SQL_IO_THREADS'])
+
+IO_POOLS = [tile_io, json_io, sql_io]
+
+def io_pool_statistics() -> dict[str, dict[str, int]]:
+#=====================================================
+    return { pool.name: pool.statistics() for pool in IO_POOLS }
+
+def shutdown_io_pools():
+#=======================
+    for pool in IO_POOLS:
+        pool.shutdown()
+
+#===============================================================================
+#===============================================================================
@@ -18,21 +18,35 @@
 #
 #===============================================================================
 
+from collections.abc import AsyncIterator
 from dataclasses import dataclass
-import os
-from typing import Optional
+from pathlib import Path
+import sqlite3
+from typing import Any, Optional
 
 #===============================================================================
 
-from litestar import get, MediaType, post, Request, Router
-from litestar.response import File
+from litestar import get, MediaType, post, Request, Response, Router
+from litestar.exceptions import SerializationException
+from litestar.response import File, Stream
+from litestar.serialization import encode_json
 
 #===============================================================================
 
-from ..knowledge import KnowledgeStore
+from ..knowledge import knowledge_query_cache, knowledge_stores, query_error, query_time_limit
 from ..knowledge.hierarchy import CACHED_SPARC_HIERARCHY
 from ..settings import settings
 
+from .io_pools import json_io, sql_io
+from .utils import file_response
+
+#===============================================================================
+
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+
+# The number of rows read at a time when streaming a query's result
+QUERY_STREAM_BATCH_SIZE = 1000
+
 #===============================================================================
 #===============================================================================
 
@@ -50,26 +64,65 @@ class KnowledgeSourcesResponse:
 
 def query_knowledge(sql: str, params: list[str]) -> dict:
 #========================================================
-    knowledge_store = KnowledgeStore(settings['FLATMAP_ROOT'])
-    result = knowledge_store.query(sql, params) if knowledge_store else {
-                'error': 'Knowledge Store not available'
-             }
-    knowledge_store.close()
-    return result
+    def execute() -> dict:
+        knowledge_store = knowledge_stores.store()
+        if not knowledge_store:
+            return { 'error': 'Knowledge Store not available' }
+        return knowledge_store.query(sql, params,
+                                     max_rows=settings['KNOWLEDGE_QUERY_MAX_ROWS'],
+                                     time_limit=settings['KNOWLEDGE_QUERY_TIME_LIMIT'])
+    return knowledge_query_cache.query(sql, params, execute)
+
+def ndjson(value: Any) -> bytes:
+#==============================
+    """
+    A line of JSON, encoded as Litestar encodes responses so that values such
+    as BLOBs are sent as they are in a non-streamed result.
+    """
+    return encode_json(value) + b'\n'
+
+async def stream_knowledge(sql: str, params: list[str]) -> AsyncIterator[bytes]:
+#===============================================================================
+    """
+    The result of a query as lines of JSON, read from the knowledge store in
+    batches so that memory use is bounded. The time limit on queries applies
+    to reading each batch.
+    """
+    time_limit = settings['KNOWLEDGE_QUERY_TIME_LIMIT']
+    try:
+        db = await sql_io.run(knowledge_stores.connect)
+    except sqlite3.Error as error:
+        yield ndjson({'error': str(error)})
+        return
+    try:
+        def execute() -> sqlite3.Cursor:
+            with query_time_limit(db, time_limit):
+                return db.execute(sql, params)
+        def fetch_rows(cursor: sqlite3.Cursor) -> list:
+            with query_time_limit(db, time_limit):
+                return cursor.fetchmany(QUERY_STREAM_BATCH_SIZE)
+        cursor = await sql_io.run(execute)
+        yield ndjson({'keys': [d[0] for d in cursor.description] if cursor.description else []})
+        while len(rows := await sql_io.run(fetch_rows, cursor)):
+            yield b''.join(ndjson(row) for row in rows)
+    except sqlite3.Error as error:
+        yield ndjson({'error': query_error(error, time_limit)})
+    except SerializationException as error:
+        yield ndjson({'error': f'Cannot encode result: {error}'})
+    finally:
+        db.close()
 
 def get_knowledge_sources() -> list[str]:
 #========================================
-    knowledge_store = KnowledgeStore(settings['FLATMAP_ROOT'])
-    sources = knowledge_store.knowledge_sources() if knowledge_store else []
-    knowledge_store.close()
-    return sources
+    knowledge_store = knowledge_stores.store()
+    return knowledge_store.knowledge_sources() if knowledge_store else []
 
 #===============================================================================
 #===============================================================================
 
 @post('query/')
-async def knowledge_query(data: QueryData, request: Request) -> dict:
-#====================================================================
+async def knowledge_query(data: QueryData, request: Request) -> dict|Stream:
+#===========================================================================
     """
     Query the flatmap server's knowledge base.
 
@@ -78,9 +131,21 @@ async def knowledge_query(data: QueryData, request: Request) -> dict:
 
     :>json array(string) keys: column names of result values
     :>json array(array(string)) values: result data rows
-    :>json string error: any error message
+    :>json boolean truncated: set if there were more rows than the server returns
+    :>json string error: any error message, including when the query takes too long
+
+    A request that accepts ``application/x-ndjson`` is sent all of the result's
+    rows as it is read, with no row limit. The first line is an object with
+    ``keys``, each following line is a row's values, and an object with
+    ``error`` is sent if the query fails.
     """
-    result = query_knowledge(data.sql, data.params if data.params is not None else [])
+    params = data.params if data.params is not None else []
+    if request.accept.best_match([MediaType.JSON, NDJSON_MEDIA_TYPE]) == NDJSON_MEDIA_TYPE:
+        # The handler's media type, resolved from its return type, would otherwise
+        # take precedence over the stream's
+        return Stream(stream_knowledge(data.sql, params), media_type=NDJSON_MEDIA_TYPE,
+                      headers={'Content-Type': NDJSON_MEDIA_TYPE})
+    result = await sql_io.run(query_knowledge, data.sql, params)
     if 'error' in result:
         request.logger.warning(f'SQL: {result["error"]}')
     return result
@@ -95,14 +160,14 @@ async def knowledge_sources() -> KnowledgeSourcesResponse:
                                   in descending order, with the most recent
                                   source at the beginning
     """
-    sources = get_knowledge_sources()
+    sources = await sql_io.run(get_knowledge_sources)
     return KnowledgeSourcesResponse(sources)
 
 @get('sparcterms')
-async def knowledge_sparcterms() -> File:
-#========================================
-    filename = os.path.join(settings['FLATMAP_ROOT'], CACHED_SPARC_HIERARCHY)
-    return File(path=filename, media_type=MediaType.JSON)
+async def knowledge_sparcterms(request: Request) -> File|Response:
+#=================================================================
+    filename = Path(settings['FLATMAP_ROOT']) / CACHED_SPARC_HIERARCHY
+    return await json_io.run(file_response, request, filename, MediaType.JSON)
 
 @get('schema-version')
 async def knowledge_schema_version(request: Request) -> dict:
@@ -110,7 +175,7 @@ async def knowledge_schema_version(request: Request) -> dict:
     """
     :>json number version: the version of the store's schema
     """
-    result = query_knowledge('select value from metadata where name=?', ['schema_version'])
+    result = await sql_io.run(query_knowledge, 'select value from metadata where name=?', ['schema_version'])
     if 'error' in result:
         request.logger.warning(f'SQL: {result["error"]}')
     return {'version': result['values'][0][0]}
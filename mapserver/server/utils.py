@@ -18,74 +18,161 @@
 #
 #===============================================================================
 
-import json
+from email.utils import formatdate, parsedate_to_datetime
+import gzip
+import hashlib
 from pathlib import Path
-from typing import Any
+from typing import Any, Optional
 
 #===============================================================================
 
-from mapserver.maker import MAKER_SENTINEL
+from litestar import Request, Response
+from litestar.response import File
+from litestar.status_codes import HTTP_304_NOT_MODIFIED
+
+#===============================================================================
+
+from mapserver.catalog import FlatmapCatalog, flatmap_catalog
 from mapserver.settings import settings
-from mapserver.utils import json_map_metadata
+from mapserver.utils import gzip_sidecar
+
+#===============================================================================
+
+def get_flatmap_list(persistent: bool=True) -> list[dict]:
+#=========================================================
+    """
+    The maps in ``FLATMAP_ROOT``. Tools which only read the directory should
+    set ``persistent`` to False so that a catalog isn't saved in it.
+    """
+    if persistent:
+        return flatmap_catalog.flatmaps()
+    return FlatmapCatalog(0, persistent=False).flatmaps()
 
 #===============================================================================
 
-def get_flatmap_list() -> list[dict]:
-#====================================
-    flatmap_list = []
-    root_path = Path(settings['FLATMAP_ROOT']).resolve()
-    if root_path.is_dir():
-        for flatmap_dir in root_path.iterdir():
-            index_file = Path(settings['FLATMAP_ROOT']) / flatmap_dir / 'index.json'
-            map_making = Path(settings['FLATMAP_ROOT']) / flatmap_dir / MAKER_SENTINEL
-            if flatmap_dir.is_dir() and not map_making.exists() and index_file.exists():
-                with open(index_file) as fp:
-                    index = json.load(fp)
-                version = index.get('version', 1.0)
-                if float(version) >= 1.3:
-                    metadata: dict[str, Any] = json_map_metadata(str(flatmap_dir), 'metadata')
-                    flatmap = {
-                        'path': str(flatmap_dir)
-                    }
-                    if (('id' not in metadata or flatmap_dir.name != metadata['id'])
-                     and ('uuid' not in metadata or flatmap_dir.name != metadata['uuid'].split(':')[-1])):
-                        flatmap['error'] = f'Flatmap id mismatch with directory: {flatmap_dir}'
-                        continue
-                    flatmap.update({
-                        'id': metadata['id'],
-                        'name': metadata.get('name', metadata['id']),
-                        'source': metadata['source'],
-                        'version': version
-                    })
-                    if 'uuid' in metadata:
-                        flatmap['uuid'] = metadata['uuid']
-                    if 'style' in index:
-                        flatmap['style'] = index['style']
-
-                    ## add later...
-                    ##id = flatmap.get('uuid', flatmap['id'])
-                    ##flatmap['uri'] = f'{request.base_url}{FLATMAP_PATH_PREFIX}/{id}/'
-
-                    if 'created' in metadata:
-                        flatmap['created'] = metadata['created']
-                        flatmap['creator'] = metadata['creator']
-                    if 'git-status' in metadata:
-                        flatmap['git-status'] = metadata['git-status']
-                    if 'taxon' in metadata:
-                        flatmap['taxon'] = metadata['taxon']
-                        flatmap['describes'] = metadata['describes'] if 'describes' in metadata else flatmap['taxon']
-                    elif 'describes' in metadata:
-                        flatmap['taxon'] = metadata['describes']
-                        flatmap['describes'] = flatmap['taxon']
-                    if 'biological-sex' in metadata:
-                        flatmap['biologicalSex'] = metadata['biological-sex']
-                    if 'name' in metadata:
-                        flatmap['name'] = metadata['name']
-                    if 'connectivity' in metadata:
-                        flatmap['sckan'] = metadata['connectivity']
-
-                    flatmap_list.append(flatmap)
-    return flatmap_list
+def accepts_encoding(request: Request, encoding: str) -> bool:
+#=============================================================
+    """
+    Does the request's ``Accept-Encoding`` header allow a response to be
+    sent with the given content coding?
+    """
+    accepted = {}
+    for coding in request.headers.get('accept-encoding', '').split(','):
+        (name, _, params) = coding.partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            (key, _, value) = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if (name := name.strip().lower()):
+            accepted[name] = quality
+    quality = accepted.get(encoding, accepted.get('*', 0.0))
+    return quality > 0.0
+
+#===============================================================================
+
+# Content of a map's directory doesn't change once the map has been made
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+class CacheValidator:
+    """
+    A strong entity tag and modification time for a representation of a
+    resource, derived from the parts that identify it.
+    """
+    def __init__(self, *parts: Any, modified: Optional[float]=None, vary: Optional[str]=None):
+        digest = hashlib.blake2b('/'.join(str(part) for part in parts).encode(), digest_size=16)
+        self.__etag = f'"{digest.hexdigest()}"'
+        self.__modified = modified
+        self.__vary = vary
+
+    @classmethod
+    def for_map_files(cls, map_uuid: str, *filenames: str, variant: str='',
+                      vary: Optional[str]=None) -> 'CacheValidator':
+    #==================================================================
+        """
+        Derive a validator from the size and modification time of files in a
+        map's directory, ignoring any that don't exist.
+        """
+        map_path = Path(settings['FLATMAP_ROOT']) / map_uuid
+        parts: list[Any] = [map_uuid, variant]
+        modified = None
+        for filename in filenames:
+            try:
+                stat = (map_path / filename).stat()
+            except OSError:
+                continue
+            parts.extend([filename, stat.st_mtime_ns, stat.st_size])
+            if modified is None or stat.st_mtime > modified:
+                modified = stat.st_mtime
+        return cls(*parts, modified=modified, vary=vary)
+
+    @property
+    def etag(self) -> str:
+        return self.__etag
+
+    @property
+    def headers(self) -> dict[str, str]:
+        headers = {
+            'Cache-Control': IMMUTABLE_CACHE_CONTROL,
+            'ETag': self.__etag,
+        }
+        if self.__modified is not None:
+            headers['Last-Modified'] = formatdate(self.__modified, usegmt=True)
+        if self.__vary is not None:
+            headers['Vary'] = self.__vary
+        return headers
+
+    def matches(self, request: Request) -> bool:
+    #===========================================
+        """
+        Does a conditional request's validator show the client has the
+        current representation?
+        """
+        if (if_none_match := request.headers.get('if-none-match')) is not None:
+            for tag in if_none_match.split(','):
+                tag = tag.strip()
+                if tag == '*' or tag.removeprefix('W/') == self.__etag:
+                    return True
+            return False
+        if (self.__modified is not None
+        and (if_modified_since := request.headers.get('if-modified-since')) is not None):
+            try:
+                return int(self.__modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                pass
+        return False
+
+    def not_modified(self) -> Response:
+    #==================================
+        return Response(content=b'', status_code=HTTP_304_NOT_MODIFIED, headers=self.headers)
+
+#===============================================================================
+
+def file_response(request: Request, path: Path, media_type: str, validator: Optional[CacheValidator]=None,
+                  **kwds: Any) -> File|Response:
+#=========================================================================================================
+    """
+    Send a file, compressed if the client accepts gzip encoding. A compressed
+    copy of the file is kept beside it, with the file only being compressed
+    for each request when the copy can't be written.
+
+    A validator should have been created with ``vary='Accept-Encoding'`` and
+    a variant that distinguishes compressed content.
+    """
+    headers = {} if validator is None else validator.headers
+    headers.setdefault('Vary', 'Accept-Encoding')
+    if accepts_encoding(request, 'gzip') and path.exists():
+        if (sidecar := gzip_sidecar(path)) is not None:
+            kwds.setdefault('filename', path.name)
+            return File(path=sidecar, media_type=media_type,
+                        headers=headers | {'Content-Encoding': 'gzip'}, **kwds)
+        with open(path, 'rb') as fp:
+            return Response(content=gzip.compress(fp.read()), media_type=media_type,
+                            headers=headers | {'Content-Encoding': 'gzip'})
+    return File(path=path, media_type=media_type, headers=headers, **kwds)
 
 #===============================================================================
 #===============================================================================
@@ -71,6 +71,39 @@ settings['FLATMAP_SERVER_WORKERS'] = os.environ.get('FLATMAP_SERVER_WORKERS', '1
 
 #===============================================================================
 
+# The maximum time, in seconds, before the catalog of maps checks for changed map directories
+settings['CATALOG_REFRESH_INTERVAL'] = float(os.environ.get('CATALOG_REFRESH_INTERVAL', '10'))
+
+# The maximum number of tile databases each worker keeps open
+settings['TILE_DATABASE_LIMIT'] = int(os.environ.get('TILE_DATABASE_LIMIT', '64'))
+
+# The size, in megabytes, of each worker's cache of recently used tiles
+settings['TILE_CACHE_SIZE'] = int(float(os.environ.get('TILE_CACHE_SIZE', '64'))*1024*1024)
+
+# The memory, in megabytes, used by the JSON metadata documents each worker keeps parsed
+settings['METADATA_CACHE_SIZE'] = int(float(os.environ.get('METADATA_CACHE_SIZE', '64'))*1024*1024)
+
+# The sizes, in megabytes, of the memory map and page cache of each connection to the knowledge store
+settings['KNOWLEDGE_MMAP_SIZE'] = int(float(os.environ.get('KNOWLEDGE_MMAP_SIZE', '256'))*1024*1024)
+settings['KNOWLEDGE_CACHE_SIZE'] = int(float(os.environ.get('KNOWLEDGE_CACHE_SIZE', '16'))*1024*1024)
+
+# The memory, in megabytes, used by the knowledge query results each worker caches
+settings['KNOWLEDGE_QUERY_CACHE_SIZE'] = int(float(os.environ.get('KNOWLEDGE_QUERY_CACHE_SIZE', '32'))*1024*1024)
+
+# The maximum time, in seconds, a knowledge query may run and the maximum number of rows it returns
+settings['KNOWLEDGE_QUERY_TIME_LIMIT'] = float(os.environ.get('KNOWLEDGE_QUERY_TIME_LIMIT', '10'))
+settings['KNOWLEDGE_QUERY_MAX_ROWS'] = int(os.environ.get('KNOWLEDGE_QUERY_MAX_ROWS', '100000'))
+
+# The number of threads each worker uses for blocking tile, JSON and SQL I/O
+settings['TILE_IO_THREADS'] = int(os.environ.get('TILE_IO_THREADS', '8'))
+settings['JSON_IO_THREADS'] = int(os.environ.get('JSON_IO_THREADS', '4'))
+settings['SQL_IO_THREADS'] = int(os.environ.get('SQL_IO_THREADS', '4'))
+
+# The number of processes used to make the derived files of newly made maps
+settings['PRECOMPUTE_PROCESSES'] = int(os.environ.get('PRECOMPUTE_PROCESSES', '2'))
+
+#===============================================================================
+
 # Bearer tokens for service authentication
 
 settings['ANNOTATOR_TOKENS'] = os.environ.get('ANNOTATOR_TOKENS', '').split()
@@ -0,0 +1,423 @@
+#===============================================================================
+#
+#  Flatmap server
+#
+#  Copyright (c) 2019-2025  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+from collections import OrderedDict
+from collections.abc import Iterable
+from pathlib import Path
+import sqlite3
+import struct
+import threading
+from typing import Optional
+
+#===============================================================================
+
+from .artifacts import artifact_lock, write_atomically
+from .settings import settings
+
+#===============================================================================
+
+# Allowance for the key and bookkeeping of a cached tile
+TILE_ENTRY_OVERHEAD = 128
+
+TileKey = tuple[str, str, tuple[int, int, int], int, int, int]
+
+class TileCache:
+    """
+    Recently used tiles, shared by all of a worker's tile databases.
+
+    Tiles are evicted, least recently used first, when their total size exceeds
+    ``max_bytes``. Tiles that don't exist are also remembered, as ``None``.
+    """
+    def __init__(self, max_bytes: int):
+        self.__max_bytes = max_bytes
+        self.__tiles: OrderedDict[TileKey, Optional[bytes]] = OrderedDict()
+        self.__bytes = 0
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def __entry_size(data: Optional[bytes]) -> int:
+    #==============================================
+        return TILE_ENTRY_OVERHEAD + (0 if data is None else len(data))
+
+    def clear(self):
+    #===============
+        with self.__lock:
+            self.__tiles.clear()
+            self.__bytes = 0
+
+    def get(self, key: TileKey) -> tuple[bool, Optional[bytes]]:
+    #===========================================================
+        with self.__lock:
+            if key in self.__tiles:
+                self.__tiles.move_to_end(key)
+                self.__hits += 1
+                return (True, self.__tiles[key])
+            self.__misses += 1
+            return (False, None)
+
+    def invalidate(self, map_uuid: str, layer: Optional[str]=None):
+    #==============================================================
+        with self.__lock:
+            for key in [key for key in self.__tiles
+                            if key[0] == map_uuid and (layer is None or key[1] == layer)]:
+                self.__bytes -= TileCache.__entry_size(self.__tiles.pop(key))
+
+    def put(self, key: TileKey, data: Optional[bytes]):
+    #==================================================
+        size = TileCache.__entry_size(data)
+        if size > self.__max_bytes:
+            return
+        with self.__lock:
+            if key in self.__tiles:
+                self.__bytes -= TileCache.__entry_size(self.__tiles.pop(key))
+            self.__tiles[key] = data
+            self.__bytes += size
+            while self.__bytes > self.__max_bytes:
+                (_, evicted) = self.__tiles.popitem(last=False)
+                self.__bytes -= TileCache.__entry_size(evicted)
+                self.__evictions += 1
+
+    def statistics(self) -> dict[str, int]:
+    #======================================
+        with self.__lock:
+            return {
+                'tiles': len(self.__tiles),
+                'bytes': self.__bytes,
+                'max-bytes': self.__max_bytes,
+                'hits': self.__hits,
+                'misses': self.__misses,
+                'evictions': self.__evictions,
+            }
+
+#===============================================================================
+
+tile_cache = TileCache(settings['TILE_CACHE_SIZE'])
+
+#===============================================================================
+
+# Zoom levels whose populated area needs more bits than this aren't indexed
+MAX_TILE_INDEX_BITS = 64*1024*1024
+
+TILE_INDEX_MAGIC = b'FMTILES1'
+TILE_INDEX_HEADER = struct.Struct('<8sQQI')
+TILE_INDEX_ZOOM = struct.Struct('<BIIII')
+
+class TileIndex:
+    """
+    Which tiles exist in a tile database, as a bitset for each zoom level
+    covering the bounding box of the zoom level's tiles.
+
+    An index is saved beside its database, along with the database's
+    modification time and size, so that it only need be rebuilt when the
+    database changes.
+    """
+    def __init__(self, zooms: dict[int, Optional[tuple[int, int, int, int, bytearray]]]):
+        self.__zooms = zooms
+
+    def exists(self, z: int, x: int, y: int) -> Optional[bool]:
+    #==========================================================
+        """
+        Does a tile exist? ``None`` means the tile's zoom level isn't indexed
+        and the database must be checked.
+        """
+        if z not in self.__zooms:
+            return False
+        if (zoom := self.__zooms[z]) is None:
+            return None
+        (min_x, min_y, width, height, bits) = zoom
+        (column, row) = (x - min_x, y - min_y)
+        if 0 <= column < width and 0 <= row < height:
+            bit = row*width + column
+            return (bits[bit >> 3] & (1 << (bit & 7))) != 0
+        return False
+
+    @classmethod
+    def build(cls, db: sqlite3.Connection) -> 'TileIndex':
+    #=====================================================
+        zooms: dict[int, Optional[tuple[int, int, int, int, bytearray]]] = {}
+        bounds = db.execute('''SELECT zoom_level, min(tile_column), max(tile_column), min(tile_row), max(tile_row)
+                                   FROM tiles GROUP BY zoom_level''').fetchall()
+        for (z, min_x, max_x, min_row, max_row) in bounds:
+            # MBTiles rows are numbered from the bottom (TMS)
+            min_y = (1 << z) - 1 - max_row
+            width = max_x - min_x + 1
+            height = max_row - min_row + 1
+            if width*height > MAX_TILE_INDEX_BITS:
+                zooms[z] = None
+            else:
+                bits = bytearray((width*height + 7)//8)
+                for (x, row) in db.execute('SELECT tile_column, tile_row FROM tiles WHERE zoom_level=?', (z,)):
+                    bit = ((1 << z) - 1 - row - min_y)*width + x - min_x
+                    bits[bit >> 3] |= 1 << (bit & 7)
+                zooms[z] = (min_x, min_y, width, height, bits)
+        return cls(zooms)
+
+    @classmethod
+    def load(cls, path: Path, signature: tuple[int, int]) -> Optional['TileIndex']:
+    #==============================================================================
+        """
+        Read a saved index, provided it was made from a database with the
+        given modification time and size.
+        """
+        try:
+            data = path.read_bytes()
+            (magic, mtime, size, count) = TILE_INDEX_HEADER.unpack_from(data)
+            if magic != TILE_INDEX_MAGIC or (mtime, size) != signature:
+                return None
+            zooms: dict[int, Optional[tuple[int, int, int, int, bytearray]]] = {}
+            offset = TILE_INDEX_HEADER.size
+            for _ in range(count):
+                (z, min_x, min_y, width, height) = TILE_INDEX_ZOOM.unpack_from(data, offset)
+                offset += TILE_INDEX_ZOOM.size
+                if width == 0:
+                    zooms[z] = None
+                else:
+                    length = (width*height + 7)//8
+                    zooms[z] = (min_x, min_y, width, height, bytearray(data[offset:offset+length]))
+                    offset += length
+            return cls(zooms) if offset == len(data) else None
+        except (OSError, struct.error):
+            return None
+
+    def save(self, path: Path, signature: tuple[int, int]):
+    #======================================================
+        """
+        Save the index, ignoring errors as the map's directory may not be writable.
+        """
+        parts = [TILE_INDEX_HEADER.pack(TILE_INDEX_MAGIC, *signature, len(self.__zooms))]
+        for (z, zoom) in sorted(self.__zooms.items()):
+            if zoom is None:
+                parts.append(TILE_INDEX_ZOOM.pack(z, 0, 0, 0, 0))
+            else:
+                parts.append(TILE_INDEX_ZOOM.pack(z, *zoom[0:4]))
+                parts.append(zoom[4])
+        try:
+            write_atomically(path, b''.join(parts))
+        except OSError:
+            pass
+
+#===============================================================================
+
+class TileDatabase:
+    """
+    A read-only connection to a map's MBTiles database.
+
+    The file's identity is remembered when it is opened so that the connection
+    can be discarded if the map is rebuilt or its directory replaced.
+    """
+    def __init__(self, map_uuid: str, layer: str):
+        self.__map_uuid = map_uuid
+        self.__layer = layer
+        self.__path = path = Path(settings['FLATMAP_ROOT']) / map_uuid / f'{layer}.mbtiles'
+        try:
+            self.__signature = TileDatabase.file_signature(path)
+            self.__db = sqlite3.connect(f'{path.resolve().as_uri()}?mode=ro', uri=True,
+                                        check_same_thread=False)
+        except (OSError, sqlite3.Error):
+            raise IOError('Cannot read tile database')
+        self.__lock = threading.Lock()
+        try:
+            self.__compressed = self.metadata('compressed') is not None
+            self.__tile_index = self.__get_tile_index()
+        except Exception:
+            # Don't leave the connection open when the database can't be used
+            self.__db.close()
+            raise
+
+    @staticmethod
+    def file_signature(path: Path) -> tuple[int, int, int]:
+    #======================================================
+        stat = path.stat()
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    @property
+    def compressed(self) -> bool:
+        return self.__compressed
+
+    @property
+    def path(self) -> Path:
+        return self.__path
+
+    @property
+    def signature(self) -> tuple[int, int, int]:
+        return self.__signature
+
+    def close(self):
+    #===============
+        with self.__lock:
+            self.__db.close()
+
+    def current(self) -> bool:
+    #=========================
+        try:
+            return TileDatabase.file_signature(self.__path) == self.__signature
+        except OSError:
+            return False
+
+    def metadata(self, name: str) -> Optional[str]:
+    #==============================================
+        row = self.__fetchone('SELECT value FROM metadata WHERE name=?', (name,))
+        return None if row is None else row[0]
+
+    def tile(self, z: int, x: int, y: int) -> Optional[bytes]:
+    #=========================================================
+        if self.__tile_index.exists(z, x, y) is False:
+            return None
+        key = self.__tile_key(z, x, y)
+        (cached, data) = tile_cache.get(key)
+        if cached:
+            return data
+        # MBTiles rows are numbered from the bottom (TMS)
+        row = self.__fetchone('SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                              (z, x, (1 << z) - 1 - y))
+        data = None if row is None else row[0]
+        tile_cache.put(key, data)
+        return data
+
+    def tiles(self, z: int, positions: Iterable[tuple[int, int]]) -> dict[tuple[int, int], bytes]:
+    #============================================================================================
+        """
+        Get the tiles at a zoom level which exist at the given ``(x, y)`` positions,
+        reading all those that aren't cached with a single query.
+        """
+        found: dict[tuple[int, int], bytes] = {}
+        wanted: set[tuple[int, int]] = set()
+        for position in positions:
+            if self.__tile_index.exists(z, *position) is False:
+                continue
+            (cached, data) = tile_cache.get(self.__tile_key(z, *position))
+            if not cached:
+                wanted.add(position)
+            elif data is not None:
+                found[position] = data
+        if len(wanted):
+            max_row = (1 << z) - 1
+            columns = sorted(set(x for (x, _) in wanted))
+            rows = sorted(set(max_row - y for (_, y) in wanted))
+            sql = ('SELECT tile_column, tile_row, tile_data FROM tiles WHERE zoom_level=?'
+                  f' AND tile_column IN ({",".join(len(columns)*"?")})'
+                  f' AND tile_row IN ({",".join(len(rows)*"?")})')
+            for (x, row, data) in self.__fetchall(sql, (z, *columns, *rows)):
+                if (position := (x, max_row - row)) in wanted:
+                    found[position] = data
+            for position in wanted:
+                tile_cache.put(self.__tile_key(z, *position), found.get(position))
+        return found
+
+    def __get_tile_index(self) -> TileIndex:
+    #=======================================
+        index_path = self.__path.with_name(f'{self.__layer}.tile-index')
+        signature = self.__signature[1:]
+        if (tile_index := TileIndex.load(index_path, signature)) is not None:
+            return tile_index
+        with artifact_lock(index_path) as locked:
+            # Another process may have saved the index while we waited
+            if locked and (tile_index := TileIndex.load(index_path, signature)) is not None:
+                return tile_index
+            try:
+                with self.__lock:
+                    tile_index = TileIndex.build(self.__db)
+            except sqlite3.Error:
+                raise IOError('Cannot read tile database')
+            tile_index.save(index_path, signature)
+        return tile_index
+
+    def __tile_key(self, z: int, x: int, y: int) -> TileKey:
+    #======================================================
+        return (self.__map_uuid, self.__layer, self.__signature, z, x, y)
+
+    def __fetchall(self, sql: str, params: tuple) -> list[tuple]:
+    #============================================================
+        try:
+            with self.__lock:
+                return self.__db.execute(sql, params).fetchall()
+        except sqlite3.Error:
+            raise IOError('Cannot read tile database')
+
+    def __fetchone(self, sql: str, params: tuple) -> Optional[tuple]:
+    #================================================================
+        try:
+            with self.__lock:
+                return self.__db.execute(sql, params).fetchone()
+        except sqlite3.Error:
+            raise IOError('Cannot read tile database')
+
+#===============================================================================
+
+class TileDatabasePool:
+    """
+    Open tile databases, keyed by map and layer, with least recently used
+    databases being closed when there are more than ``max_open``.
+    """
+    def __init__(self, max_open: int):
+        self.__max_open = max(1, max_open)
+        self.__databases: OrderedDict[tuple[str, str], TileDatabase] = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def close(self):
+    #===============
+        with self.__lock:
+            for database in self.__databases.values():
+                database.close()
+            self.__databases.clear()
+
+    def get(self, map_uuid: str, layer: str) -> TileDatabase:
+    #========================================================
+        key = (map_uuid, layer)
+        with self.__lock:
+            database = self.__databases.get(key)
+            if database is not None:
+                if database.current():
+                    self.__databases.move_to_end(key)
+                    return database
+                del self.__databases[key]
+                database.close()
+                tile_cache.invalidate(map_uuid, layer)
+        database = TileDatabase(map_uuid, layer)
+        with self.__lock:
+            if (existing := self.__databases.get(key)) is not None and existing.signature == database.signature:
+                # Another thread has opened the same database
+                database.close()
+                self.__databases.move_to_end(key)
+                return existing
+            elif existing is not None:
+                existing.close()
+            self.__databases[key] = database
+            while len(self.__databases) > self.__max_open:
+                (_, evicted) = self.__databases.popitem(last=False)
+                evicted.close()
+        return database
+
+    def invalidate(self, map_uuid: str):
+    #===================================
+        with self.__lock:
+            for key in [key for key in self.__databases if key[0] == map_uuid]:
+                self.__databases.pop(key).close()
+        tile_cache.invalidate(map_uuid)
+
+#===============================================================================
+
+tile_databases = TileDatabasePool(settings['TILE_DATABASE_LIMIT'])
+
+#===============================================================================
+#===============================================================================
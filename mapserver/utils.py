@@ -18,10 +18,15 @@
 #
 #===============================================================================
 
+from collections import OrderedDict
+from collections.abc import Callable
+import gzip
+import itertools
 import json
-import os
 from pathlib import Path
 import sqlite3
+import sys
+import threading
 from typing import Any, Optional
 
 #===============================================================================
@@ -30,6 +35,7 @@ from landez.sources import MBTilesReader, InvalidFormatError
 
 #===============================================================================
 
+from .artifacts import artifact_lock, write_atomically
 from .settings import settings
 
 #===============================================================================
@@ -49,23 +55,309 @@ def json_metadata(tile_reader: MBTilesReader, name: str) -> dict[str, Any]:
         raise IOError('Cannot read tile database')
     return {} if row is None else json.loads(row[0])
 
+#===============================================================================
+
+# The number of members of a container measured when estimating its size
+OBJECT_SIZE_SAMPLES = 32
+
+def object_size(value: Any) -> int:
+#=================================
+    """
+    An estimate of the memory used by a parsed JSON document or query result.
+    Only a sample of the members of large containers is measured, so that the
+    estimate is much quicker to make than parsing the document.
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        members: Any = value.items()
+    elif isinstance(value, (list, tuple)):
+        members = value
+    else:
+        return size
+    if (count := len(members)) == 0:
+        return size
+    sample = list(itertools.islice(members, 0, None, max(1, count//OBJECT_SIZE_SAMPLES)))
+    if isinstance(value, dict):
+        sampled_size = sum(object_size(key) + object_size(member) for (key, member) in sample)
+    else:
+        sampled_size = sum(object_size(member) for member in sample)
+    return size + sampled_size*count//len(sample)
+
+#===============================================================================
+
+class MetadataCache:
+    """
+    Parsed JSON documents from map directories, keyed by the file they were
+    read from and validated against the file's modification time and size.
+
+    Documents are evicted, least recently used first, when the total memory
+    they use exceeds ``max_bytes``. Cached documents are shared and must not
+    be modified.
+    """
+    def __init__(self, max_bytes: int):
+        self.__max_bytes = max_bytes
+        self.__documents: OrderedDict[tuple[str, str, str], tuple[tuple[int, int], int, Any]] = OrderedDict()
+        self.__bytes = 0
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+        self.__lock = threading.Lock()
+
+    def clear(self):
+    #===============
+        with self.__lock:
+            self.__documents.clear()
+            self.__bytes = 0
+
+    def json_file(self, path: Path) -> Any:
+    #======================================
+        def load() -> tuple[Any, int]:
+            with open(path, 'rb') as fp:
+                document = json.load(fp)
+            return (document, object_size(document))
+        return self.__get((str(path), '', ''), path, load)
+
+    def json_section(self, path: Path, name: str, offset: int, length: int) -> Any:
+    #==============================================================================
+        """
+        A JSON document stored at ``offset`` in a file containing several.
+        """
+        def load() -> tuple[Any, int]:
+            with open(path, 'rb') as fp:
+                fp.seek(offset)
+                document = json.loads(fp.read(length))
+            return (document, object_size(document))
+        return self.__get((str(path), name, ''), path, load)
+
+    def json_bytes(self, path: Path, name: str, load: Callable[[], bytes], gzipped: bool=False) -> bytes:
+    #==================================================================================================
+        """
+        Serialised JSON, as returned by ``load()``, derived from a file and
+        optionally gzip compressed.
+        """
+        def load_bytes() -> tuple[bytes, int]:
+            data = load()
+            if gzipped:
+                data = gzip.compress(data, compresslevel=6)
+            return (data, len(data))
+        return self.__get((str(path), name, 'gzip' if gzipped else 'json'), path, load_bytes)
+
+    def mbtiles_metadata(self, path: Path, name: str) -> dict[str, Any]:
+    #===================================================================
+        def load() -> tuple[Any, int]:
+            try:
+                row = get_metadata(MBTilesReader(path), name)
+            except (InvalidFormatError, sqlite3.OperationalError):
+                raise IOError('Cannot read tile database')
+            document = {} if row is None else json.loads(row[0])
+            return (document, object_size(document))
+        return self.__get((str(path), name, ''), path, load)
+
+    def statistics(self) -> dict[str, int]:
+    #======================================
+        with self.__lock:
+            return {
+                'documents': len(self.__documents),
+                'bytes': self.__bytes,
+                'max-bytes': self.__max_bytes,
+                'hits': self.__hits,
+                'misses': self.__misses,
+                'evictions': self.__evictions,
+            }
+
+    def __get(self, key: tuple[str, str, str], path: Path, load: Callable[[], tuple[Any, int]]) -> Any:
+    #=================================================================================================
+        stat = path.stat()
+        signature = (stat.st_mtime_ns, stat.st_size)
+        with self.__lock:
+            if (entry := self.__documents.get(key)) is not None:
+                if entry[0] == signature:
+                    self.__documents.move_to_end(key)
+                    self.__hits += 1
+                    return entry[2]
+                del self.__documents[key]
+                self.__bytes -= entry[1]
+            self.__misses += 1
+        (document, size) = load()
+        if size <= self.__max_bytes:
+            with self.__lock:
+                if (entry := self.__documents.pop(key, None)) is not None:
+                    self.__bytes -= entry[1]
+                self.__documents[key] = (signature, size, document)
+                self.__bytes += size
+                while self.__bytes > self.__max_bytes:
+                    (_, evicted) = self.__documents.popitem(last=False)
+                    self.__bytes -= evicted[1]
+                    self.__evictions += 1
+        return document
+
+metadata_cache = MetadataCache(settings['METADATA_CACHE_SIZE'])
+
+#===============================================================================
+
+"""
+Each top-level section of a map's ``annotations.json`` is also written to
+``ANNOTATION_SECTIONS``, with the manifest giving the offset and length of
+every section, so that a section can be read without parsing the whole file.
+The sections are written when a map's derived files are precomputed, never
+when metadata is read.
+"""
+ANNOTATION_SECTIONS = 'annotations.sections'
+ANNOTATION_SECTIONS_MANIFEST = 'annotations.manifest.json'
+
+# Annotation files whose sections couldn't be written, as (path, mtime, size)
+UNSPLIT_ANNOTATIONS: set[tuple[str, int, int]] = set()
+
+def split_annotations(map_path: Path) -> Optional[dict[str, list[int]]]:
+#=======================================================================
+    """
+    Write the sections of a map's annotations to a separate file, returning
+    the offset and length of each, or None if the files can't be written.
+    """
+    annotation_file = map_path / 'annotations.json'
+    stat = annotation_file.stat()
+    source = [stat.st_mtime_ns, stat.st_size]
+    if (str(annotation_file), *source) in UNSPLIT_ANNOTATIONS:
+        return None
+    with open(annotation_file) as fp:
+        annotations = json.load(fp)
+    sections: dict[str, list[int]] = {}
+    parts = []
+    offset = 0
+    for (name, section) in annotations.items():
+        data = json.dumps(section).encode()
+        sections[name] = [offset, len(data)]
+        parts.append(data)
+        offset += len(data)
+    manifest = json.dumps({'source': source, 'sections': sections}).encode()
+    try:
+        # The manifest is written last so that it never refers to an incomplete file
+        write_atomically(map_path / ANNOTATION_SECTIONS, b''.join(parts))
+        write_atomically(map_path / ANNOTATION_SECTIONS_MANIFEST, manifest)
+    except OSError:
+        UNSPLIT_ANNOTATIONS.add((str(annotation_file), *source))
+        return None
+    return sections
+
+def save_annotation_sections(map_path: Path) -> Optional[dict[str, list[int]]]:
+#==============================================================================
+    """
+    The offset and length of each section of a map's annotations, splitting
+    the annotations if they haven't already been.
+    """
+    if (sections := annotation_sections(map_path)) is not None:
+        return sections
+    with artifact_lock(map_path / ANNOTATION_SECTIONS) as locked:
+        # Another process may have split the annotations while we waited
+        if locked and (sections := annotation_sections(map_path)) is not None:
+            return sections
+        return split_annotations(map_path)
+
+def annotation_sections(map_path: Path) -> Optional[dict[str, list[int]]]:
+#=========================================================================
+    """
+    The offset and length of each section of a map's annotations, or None if
+    the annotations haven't been split since they were last changed, in which
+    case the whole of ``annotations.json`` must be read.
+    """
+    stat = (map_path / 'annotations.json').stat()
+    try:
+        manifest = metadata_cache.json_file(map_path / ANNOTATION_SECTIONS_MANIFEST)
+        if manifest.get('source') == [stat.st_mtime_ns, stat.st_size]:
+            return manifest['sections']
+    except (KeyError, OSError, ValueError):
+        pass
+    return None
+
+#===============================================================================
+
+"""
+Compressed copies of large files served from map directories have this
+suffix appended to the file's name
+"""
+GZIP_SIDECAR_SUFFIX = '.gz'
+
+def gzip_sidecar(path: Path) -> Optional[Path]:
+#==============================================
+    """
+    The path of a gzip compressed copy of a file, writing the copy if there
+    isn't a current one. A copy is given its original's modification time so
+    that a stale copy can be recognised. None is returned if the copy can't
+    be written.
+    """
+    sidecar = path.with_name(f'{path.name}{GZIP_SIDECAR_SUFFIX}')
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    def sidecar_current() -> bool:
+        try:
+            return sidecar.stat().st_mtime_ns == stat.st_mtime_ns
+        except OSError:
+            return False
+    if sidecar_current():
+        return sidecar
+    with artifact_lock(sidecar) as locked:
+        # Another process may have compressed the file while we waited
+        if locked and sidecar_current():
+            return sidecar
+        try:
+            with open(path, 'rb') as fp:
+                write_atomically(sidecar, gzip.compress(fp.read(), compresslevel=9), stat.st_mtime_ns)
+        except OSError:
+            return None
+    return sidecar
+
+#===============================================================================
+
 def json_map_metadata(map_id: str, name: str) -> dict[str, Any]:
 #===============================================================
+    """
+    A section of a map's metadata. The result is shared with other callers
+    and must not be modified.
+    """
     map_path = Path(settings['FLATMAP_ROOT']) / map_id
-    index = map_path / 'index.json'
-    with open(index) as fp:
-        version = float(json.load(fp).get('version', 1.6))
+    index = metadata_cache.json_file(map_path / 'index.json')
+    version = float(index.get('version', 1.6))
     if version < 2.0:
         mbtiles = map_path / 'index.mbtiles'
         if mbtiles.exists():
-            return json_metadata(MBTilesReader(mbtiles), name)
+            return metadata_cache.mbtiles_metadata(mbtiles, name)
     else:
         annotation_file = map_path / 'annotations.json'
         if annotation_file.exists():
-            with open(annotation_file) as fp:
-                annotation = json.load(fp)
-            return annotation.get(name, {})
+            if (sections := annotation_sections(map_path)) is None:
+                return metadata_cache.json_file(annotation_file).get(name, {})
+            elif (location := sections.get(name)) is not None:
+                return metadata_cache.json_section(map_path / ANNOTATION_SECTIONS, name, *location)
     return {}
 
+def json_map_metadata_bytes(map_id: str, name: str, gzipped: bool=False) -> bytes:
+#=================================================================================
+    """
+    A section of a map's metadata as serialised JSON, optionally gzip compressed.
+
+    Sections of split annotations are returned as stored, without being parsed.
+    """
+    map_path = Path(settings['FLATMAP_ROOT']) / map_id
+    index = metadata_cache.json_file(map_path / 'index.json')
+    if float(index.get('version', 1.6)) < 2.0:
+        source_file = map_path / 'index.mbtiles'
+    else:
+        source_file = map_path / 'annotations.json'
+        if source_file.exists() and (sections := annotation_sections(map_path)) is not None:
+            if (location := sections.get(name)) is None:
+                return metadata_cache.json_bytes(source_file, name, lambda: b'{}', gzipped)
+            sections_file = map_path / ANNOTATION_SECTIONS
+            def read_section() -> bytes:
+                with open(sections_file, 'rb') as fp:
+                    fp.seek(location[0])
+                    return fp.read(location[1])
+            return metadata_cache.json_bytes(sections_file, name, read_section, gzipped)
+    if not source_file.exists():
+        source_file = map_path / 'index.json'
+    return metadata_cache.json_bytes(source_file, name,
+                                     lambda: json.dumps(json_map_metadata(map_id, name)).encode(), gzipped)
+
 #===============================================================================
 #===============================================================================
@@ -0,0 +1,7 @@
+import os
+import tempfile
+
+# The server's settings require these directories to exist when imported
+for variable in ('FLATMAP_ROOT', 'FLATMAP_SERVER_LOGS'):
+    if not os.path.isdir(os.environ.get(variable, '')):
+        os.environ[variable] = tempfile.mkdtemp()
@@ -0,0 +1,56 @@
+import json
+
+import pytest
+
+from mapserver.settings import settings
+from mapserver.utils import (ANNOTATION_SECTIONS, ANNOTATION_SECTIONS_MANIFEST, annotation_sections,
+                             json_map_metadata, json_map_metadata_bytes, save_annotation_sections)
+
+MAP_UUID = 'test-map'
+
+ANNOTATIONS = {
+    'metadata': {'id': MAP_UUID, 'name': 'A  map'},
+    'pathways': {'paths': {'ilxtr:path-1': {'connectivity': []}}},
+}
+
+@pytest.fixture
+def map_path(tmp_path, monkeypatch):
+    map_path = tmp_path / MAP_UUID
+    map_path.mkdir()
+    (map_path / 'index.json').write_text(json.dumps({'version': 2.0}))
+    (map_path / 'annotations.json').write_text(json.dumps(ANNOTATIONS))
+    monkeypatch.setitem(settings, 'FLATMAP_ROOT', str(tmp_path))
+    return map_path
+
+def map_files(map_path):
+    return sorted(path.name for path in map_path.iterdir())
+
+def test_read_without_sections(map_path):
+    files = map_files(map_path)
+    assert annotation_sections(map_path) is None
+    assert json_map_metadata(MAP_UUID, 'metadata') == ANNOTATIONS['metadata']
+    assert json.loads(json_map_metadata_bytes(MAP_UUID, 'pathways')) == ANNOTATIONS['pathways']
+    assert json_map_metadata(MAP_UUID, 'missing') == {}
+    assert map_files(map_path) == files
+
+def test_read_with_sections(map_path):
+    sections = save_annotation_sections(map_path)
+    assert sections is not None
+    assert (map_path / ANNOTATION_SECTIONS).exists()
+    assert (map_path / ANNOTATION_SECTIONS_MANIFEST).exists()
+    assert annotation_sections(map_path) == sections
+    assert json_map_metadata(MAP_UUID, 'metadata') == ANNOTATIONS['metadata']
+    assert json.loads(json_map_metadata_bytes(MAP_UUID, 'pathways')) == ANNOTATIONS['pathways']
+    assert json_map_metadata_bytes(MAP_UUID, 'missing') == b'{}'
+
+def test_changed_annotations(map_path):
+    save_annotation_sections(map_path)
+    annotations = ANNOTATIONS | {'metadata': {'id': MAP_UUID, 'name': 'A changed map'}}
+    (map_path / 'annotations.json').write_text(json.dumps(annotations))
+    files = map_files(map_path)
+    assert annotation_sections(map_path) is None
+    assert json_map_metadata(MAP_UUID, 'metadata') == annotations['metadata']
+    assert map_files(map_path) == files
+    save_annotation_sections(map_path)
+    assert annotation_sections(map_path) is not None
+    assert json_map_metadata(MAP_UUID, 'metadata') == annotations['metadata']
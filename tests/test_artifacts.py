@@ -0,0 +1,50 @@
+import json
+import threading
+import time
+
+from mapserver.artifacts import ARTIFACT_LOCK_FILE, artifact_current, artifact_lock, make_json_artifact
+from mapserver.utils import gzip_sidecar
+
+def test_make_json_artifact(tmp_path):
+    path = tmp_path / 'derived.json'
+    calls = []
+    def make():
+        calls.append(1)
+        return {'made': len(calls)}
+    assert make_json_artifact(path, '1', 'source', make) is None
+    assert json.loads(path.read_text()) == {'made': 1}
+    assert artifact_current(path, '1', 'source')
+    assert make_json_artifact(path, '1', 'source', make) is None
+    assert len(calls) == 1
+    assert make_json_artifact(path, '1', 'changed', make) is None
+    assert json.loads(path.read_text()) == {'made': 2}
+    assert make_json_artifact(path, '2', 'changed', make) is None
+    assert len(calls) == 3
+
+def test_one_lock_file(tmp_path):
+    (tmp_path / 'style.json').write_text('{}')
+    make_json_artifact(tmp_path / 'first.json', '1', 'source', lambda: {})
+    make_json_artifact(tmp_path / 'second.json', '1', 'source', lambda: {})
+    gzip_sidecar(tmp_path / 'style.json')
+    assert [path.name for path in tmp_path.glob('*lock*')] == [ARTIFACT_LOCK_FILE]
+
+def test_lock_is_exclusive(tmp_path):
+    events = []
+    def make(name):
+        with artifact_lock(tmp_path / name) as locked:
+            assert locked
+            events.append(f'{name} start')
+            time.sleep(0.05)
+            events.append(f'{name} end')
+    threads = [threading.Thread(target=make, args=(name,)) for name in ('a', 'b')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [event.split()[1] for event in events] == ['start', 'end', 'start', 'end']
+
+def test_not_writable(tmp_path):
+    path = tmp_path / 'missing' / 'derived.json'
+    with artifact_lock(path) as locked:
+        assert not locked
+    assert make_json_artifact(path, '1', 'source', lambda: {'made': True}) == {'made': True}
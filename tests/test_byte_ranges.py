@@ -0,0 +1,70 @@
+import pytest
+from litestar.exceptions import HTTPException
+from litestar.status_codes import HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
+
+from mapserver.server.flatmap import MAX_BYTE_RANGES, multipart_byteranges, parse_range_header
+
+FILE_SIZE = 100
+
+class Archive:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.size = len(data)
+
+    def stream(self, start, end):
+        yield self.data[start:end+1]
+
+def test_single_range():
+    assert parse_range_header('bytes=10-19', FILE_SIZE) == [(10, 19)]
+
+def test_open_ended_range():
+    assert parse_range_header('bytes=90-', FILE_SIZE) == [(90, 99)]
+
+def test_suffix_range():
+    assert parse_range_header('bytes=-10', FILE_SIZE) == [(90, 99)]
+    assert parse_range_header('bytes=-500', FILE_SIZE) == [(0, 99)]
+
+def test_end_past_file():
+    assert parse_range_header('bytes=50-500', FILE_SIZE) == [(50, 99)]
+
+def test_ranges_sorted():
+    assert parse_range_header('bytes=50-59, 0-9', FILE_SIZE) == [(0, 9), (50, 59)]
+
+def test_overlapping_ranges_merged():
+    assert parse_range_header('bytes=0-19, 10-29, 25-39', FILE_SIZE) == [(0, 39)]
+
+def test_adjacent_ranges_merged():
+    assert parse_range_header('bytes=0-9,10-19', FILE_SIZE) == [(0, 19)]
+
+def test_unsatisfiable_ranges_dropped():
+    assert parse_range_header('bytes=0-9, 200-300', FILE_SIZE) == [(0, 9)]
+
+@pytest.mark.parametrize('header', [
+    'bytes=200-300',
+    'bytes=100-',
+    'bytes=-0',
+    'bytes=20-10',
+    'bytes=a-b',
+    'bytes=',
+    'items=0-9',
+    '0-9',
+    'bytes=' + ','.join(f'{2*n}-{2*n}' for n in range(MAX_BYTE_RANGES + 1)),
+])
+def test_not_satisfiable(header):
+    with pytest.raises(HTTPException) as excinfo:
+        parse_range_header(header, FILE_SIZE)
+    assert excinfo.value.status_code == HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
+    assert excinfo.value.headers['Content-Range'] == f'bytes */{FILE_SIZE}'
+
+def test_multipart_byteranges():
+    archive = Archive(bytes(range(FILE_SIZE)))
+    (length, body) = multipart_byteranges(archive, [(0, 9), (50, 59)], 'BOUNDARY')
+    content = b''.join(body)
+    assert length == len(content)
+    parts = content.split(b'--BOUNDARY')
+    assert parts[0] == b''
+    assert parts[-1] == b'--\r\n'
+    assert parts[1] == (b'\r\nContent-Type: application/vnd.pmtiles\r\n'
+                        b'Content-Range: bytes 0-9/100\r\n\r\n' + bytes(range(0, 10)) + b'\r\n')
+    assert parts[2] == (b'\r\nContent-Type: application/vnd.pmtiles\r\n'
+                        b'Content-Range: bytes 50-59/100\r\n\r\n' + bytes(range(50, 60)) + b'\r\n')
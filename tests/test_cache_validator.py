@@ -0,0 +1,83 @@
+import os
+
+import pytest
+from litestar import Litestar
+from litestar.testing import TestClient
+
+from mapserver.server.flatmap import flatmap_style
+from mapserver.server.utils import CacheValidator
+from mapserver.settings import settings
+
+MAP_UUID = 'test-map'
+
+@pytest.fixture
+def map_path(tmp_path, monkeypatch):
+    map_path = tmp_path / MAP_UUID
+    map_path.mkdir()
+    (map_path / 'style.json').write_text('{"version": 8}')
+    monkeypatch.setitem(settings, 'FLATMAP_ROOT', str(tmp_path))
+    return map_path
+
+@pytest.fixture
+def client(map_path):
+    with TestClient(app=Litestar(route_handlers=[flatmap_style])) as client:
+        yield client
+
+def test_etag_from_files(map_path):
+    validator = CacheValidator.for_map_files(MAP_UUID, 'style.json')
+    assert validator.etag == CacheValidator.for_map_files(MAP_UUID, 'style.json').etag
+    assert validator.etag != CacheValidator.for_map_files(MAP_UUID, 'style.json', variant='gzip').etag
+    assert validator.etag.startswith('"') and validator.etag.endswith('"')
+    assert validator.headers['ETag'] == validator.etag
+    assert 'Last-Modified' in validator.headers
+    stat = (map_path / 'style.json').stat()
+    os.utime(map_path / 'style.json', ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert validator.etag != CacheValidator.for_map_files(MAP_UUID, 'style.json').etag
+
+def test_missing_files_ignored(map_path):
+    validator = CacheValidator.for_map_files(MAP_UUID, 'style.json', 'missing.json')
+    assert validator.etag == CacheValidator.for_map_files(MAP_UUID, 'style.json').etag
+    assert 'Last-Modified' not in CacheValidator.for_map_files(MAP_UUID, 'missing.json').headers
+
+def test_response_validators(client):
+    response = client.get(f'/flatmap/{MAP_UUID}/style')
+    assert response.status_code == 200
+    assert response.json() == {'version': 8}
+    assert response.headers['etag'].startswith('"')
+    assert 'last-modified' in response.headers
+    assert 'immutable' in response.headers['cache-control']
+
+@pytest.mark.parametrize('if_none_match', ['{etag}', 'W/{etag}', '"other", {etag}', '*'])
+def test_not_modified(client, if_none_match):
+    etag = client.get(f'/flatmap/{MAP_UUID}/style').headers['etag']
+    response = client.get(f'/flatmap/{MAP_UUID}/style',
+                          headers={'If-None-Match': if_none_match.format(etag=etag)})
+    assert response.status_code == 304
+    assert response.content == b''
+    assert response.headers['etag'] == etag
+
+def test_modified(client):
+    response = client.get(f'/flatmap/{MAP_UUID}/style', headers={'If-None-Match': '"other"'})
+    assert response.status_code == 200
+    assert response.json() == {'version': 8}
+
+def test_if_modified_since(client):
+    last_modified = client.get(f'/flatmap/{MAP_UUID}/style').headers['last-modified']
+    response = client.get(f'/flatmap/{MAP_UUID}/style', headers={'If-Modified-Since': last_modified})
+    assert response.status_code == 304
+    response = client.get(f'/flatmap/{MAP_UUID}/style',
+                          headers={'If-Modified-Since': 'Mon, 01 Jan 2001 00:00:00 GMT'})
+    assert response.status_code == 200
+
+def test_if_none_match_takes_precedence(client):
+    last_modified = client.get(f'/flatmap/{MAP_UUID}/style').headers['last-modified']
+    response = client.get(f'/flatmap/{MAP_UUID}/style',
+                          headers={'If-None-Match': '"other"', 'If-Modified-Since': last_modified})
+    assert response.status_code == 200
+
+def test_file_changed(client, map_path):
+    etag = client.get(f'/flatmap/{MAP_UUID}/style').headers['etag']
+    (map_path / 'style.json').write_text('{"version": 8, "name": "changed"}')
+    response = client.get(f'/flatmap/{MAP_UUID}/style', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['etag'] != etag
@@ -0,0 +1,96 @@
+import json
+
+import pytest
+
+from mapserver.catalog import FlatmapCatalog, directory_signature
+from mapserver.settings import settings
+
+# (directory, taxon, biological sex, created)
+MAPS = [
+    ('map-a', 'NCBITaxon:9606', 'PATO:0000384', '2024-01-01T00:00:00'),
+    ('map-b', 'NCBITaxon:9606', 'PATO:0000384', '2024-03-01T00:00:00'),
+    ('map-c', 'NCBITaxon:10114', None, '2024-02-01T00:00:00'),
+    ('map-d', 'NCBITaxon:9606', 'PATO:0000383', '2024-04-01T00:00:00'),
+    ('map-e', 'NCBITaxon:9606', 'PATO:0000383', '2024-04-01T00:00:00'),
+]
+
+@pytest.fixture
+def catalog(tmp_path, monkeypatch):
+    for (directory, taxon, sex, created) in MAPS:
+        map_path = tmp_path / directory
+        map_path.mkdir()
+        (map_path / 'index.json').write_text(json.dumps({'version': 2.0, 'style': 'anatomical'}))
+        metadata = {'id': directory, 'source': 'test', 'taxon': taxon,
+                    'created': created, 'creator': 'test'}
+        if sex is not None:
+            metadata['biological-sex'] = sex
+        (map_path / 'annotations.json').write_text(json.dumps({'metadata': metadata}))
+    (tmp_path / 'not-a-map').mkdir()
+    monkeypatch.setitem(settings, 'FLATMAP_ROOT', str(tmp_path))
+    return FlatmapCatalog(0, persistent=False)
+
+def directories(flatmaps):
+    return [flatmap['id'] for flatmap in flatmaps]
+
+def test_flatmaps(catalog):
+    assert sorted(directories(catalog.flatmaps())) == ['map-a', 'map-b', 'map-c', 'map-d', 'map-e']
+
+def test_not_persistent(catalog, tmp_path):
+    files = sorted(path.relative_to(tmp_path) for path in tmp_path.rglob('*'))
+    catalog.flatmaps()
+    assert sorted(path.relative_to(tmp_path) for path in tmp_path.rglob('*')) == files
+
+def test_signature_ignores_derived_files(catalog, tmp_path):
+    map_path = tmp_path / 'map-a'
+    signature = directory_signature(map_path)
+    (map_path / 'pathways.sqlite').write_bytes(b'derived')
+    (map_path / 'style.json.gz').write_bytes(b'derived')
+    assert directory_signature(map_path) == signature
+    (map_path / 'index.json').write_text(json.dumps({'version': 2.0, 'style': 'functional', 'id': 'map-a'}))
+    assert directory_signature(map_path) != signature
+
+def test_query_order(catalog):
+    (flatmaps, cursor) = catalog.query()
+    assert directories(flatmaps) == ['map-e', 'map-d', 'map-b', 'map-c', 'map-a']
+    assert cursor is None
+
+def test_query_conditions(catalog):
+    (flatmaps, _) = catalog.query(taxon='NCBITaxon:9606', sex='PATO:0000384')
+    assert directories(flatmaps) == ['map-b', 'map-a']
+    (flatmaps, _) = catalog.query(created_after='2024-02-01T00:00:00')
+    assert directories(flatmaps) == ['map-e', 'map-d', 'map-b']
+    (flatmaps, _) = catalog.query(style='functional')
+    assert flatmaps == []
+
+def test_query_latest(catalog):
+    (flatmaps, _) = catalog.query(latest=True)
+    assert directories(flatmaps) == ['map-e', 'map-b', 'map-c']
+    (flatmaps, _) = catalog.query(taxon='NCBITaxon:9606', latest=True)
+    assert directories(flatmaps) == ['map-e', 'map-b']
+
+def test_query_paging(catalog):
+    pages = []
+    cursor = None
+    while True:
+        (flatmaps, cursor) = catalog.query(limit=2, cursor=cursor)
+        pages.append(directories(flatmaps))
+        if cursor is None:
+            break
+    assert pages == [['map-e', 'map-d'], ['map-b', 'map-c'], ['map-a']]
+
+def test_query_latest_paging(catalog):
+    (flatmaps, cursor) = catalog.query(latest=True, limit=2)
+    assert directories(flatmaps) == ['map-e', 'map-b']
+    (flatmaps, cursor) = catalog.query(latest=True, limit=2, cursor=cursor)
+    assert directories(flatmaps) == ['map-c']
+    assert cursor is None
+
+def test_query_exact_page(catalog):
+    (flatmaps, cursor) = catalog.query(limit=5)
+    assert len(flatmaps) == 5
+    assert cursor is None
+
+@pytest.mark.parametrize('cursor', ['not a cursor', 'WzEsIDJd', ''])
+def test_invalid_cursor(catalog, cursor):
+    with pytest.raises(ValueError):
+        catalog.query(cursor=cursor)
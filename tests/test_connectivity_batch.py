@@ -0,0 +1,108 @@
+import json
+
+import pytest
+from litestar import Litestar
+from litestar.testing import TestClient
+
+import mapserver.server.flatmap
+from mapserver.server.flatmap import MAX_BATCH_PATHS, flatmap_connectivity_batch
+from mapserver.settings import settings
+
+MAP_UUID = 'test-map'
+
+PATHS = {
+    'ilxtr:path-1': {'connectivity': [['a', 'b']], 'axons': ['b']},
+    'ilxtr:path-2': {'connectivity': [['b', 'c']], 'somas': ['b']},
+    'ilxtr:path-3': {'connectivity': [['c', 'd']]},
+}
+
+NODE_PATHS = {
+    'b': ['ilxtr:path-1', 'ilxtr:path-2'],
+}
+
+@pytest.fixture
+def metadata(tmp_path, monkeypatch):
+    map_path = tmp_path / MAP_UUID
+    map_path.mkdir()
+    metadata = {'id': MAP_UUID, 'source': 'test'}
+    def write_annotations():
+        (map_path / 'annotations.json').write_text(json.dumps({
+            'metadata': metadata,
+            'pathways': {'paths': PATHS, 'node-paths': NODE_PATHS}
+        }))
+    (map_path / 'index.json').write_text(json.dumps({'version': 2.0}))
+    write_annotations()
+    monkeypatch.setitem(settings, 'FLATMAP_ROOT', str(tmp_path))
+    return (metadata, write_annotations)
+
+@pytest.fixture
+def client(metadata):
+    with TestClient(app=Litestar(route_handlers=[flatmap_connectivity_batch])) as client:
+        yield client
+
+def connectivity(client, **params):
+    return client.get(f'/flatmap/{MAP_UUID}/connectivity', params=params)
+
+def test_paths(client):
+    response = connectivity(client, paths='ilxtr:path-1, ilxtr:path-3')
+    assert response.status_code == 200
+    result = response.json()
+    assert sorted(result['paths']) == ['ilxtr:path-1', 'ilxtr:path-3']
+    assert result['paths']['ilxtr:path-1']['id'] == 'ilxtr:path-1'
+    assert result['paths']['ilxtr:path-1']['connectivity'] == [['a', 'b']]
+    assert result['paths']['ilxtr:path-1']['axons'] == ['b']
+    assert result['paths']['ilxtr:path-3']['somas'] == []
+    assert result['unknown'] == []
+    assert 'error' not in result
+
+def test_unknown_paths(client):
+    result = connectivity(client, paths='ilxtr:path-2,ilxtr:missing,not-a-path').json()
+    assert list(result['paths']) == ['ilxtr:path-2']
+    assert result['unknown'] == ['ilxtr:missing', 'not-a-path']
+
+def test_feature(client):
+    result = connectivity(client, feature='b', paths='ilxtr:path-3,ilxtr:path-1').json()
+    assert sorted(result['paths']) == ['ilxtr:path-1', 'ilxtr:path-2', 'ilxtr:path-3']
+    assert result['unknown'] == []
+
+def test_feature_without_paths(client):
+    response = connectivity(client, feature='z')
+    assert response.status_code == 400
+
+@pytest.mark.parametrize('params', [{}, {'paths': ''}, {'paths': ' , '}])
+def test_no_paths(client, params):
+    response = connectivity(client, **params)
+    assert response.status_code == 400
+    assert 'No paths specified' in response.text
+
+def test_too_many_paths(client):
+    paths = ','.join(f'ilxtr:path-{n}' for n in range(MAX_BATCH_PATHS + 1))
+    response = connectivity(client, paths=paths)
+    assert response.status_code == 400
+    assert 'Too many paths' in response.text
+
+def test_knowledge(client, metadata, monkeypatch):
+    (map_metadata, write_annotations) = metadata
+    map_metadata['connectivity'] = {'knowledge-source': 'sckan-test'}
+    write_annotations()
+    queries = []
+    def query_knowledge(sql, params):
+        queries.append(params)
+        return {'keys': ('entity', 'knowledge'),
+                'values': [('ilxtr:path-1', json.dumps({'label': 'Path one', 'unused': 1}))]}
+    monkeypatch.setattr(mapserver.server.flatmap, 'query_knowledge', query_knowledge)
+    result = connectivity(client, paths='ilxtr:path-1,ilxtr:path-2,ilxtr:missing').json()
+    assert queries == [['sckan-test', 'ilxtr:path-1', 'ilxtr:path-2']]
+    assert result['paths']['ilxtr:path-1']['label'] == 'Path one'
+    assert 'unused' not in result['paths']['ilxtr:path-1']
+    assert 'label' not in result['paths']['ilxtr:path-2']
+
+def test_knowledge_error(client, metadata, monkeypatch):
+    (map_metadata, write_annotations) = metadata
+    map_metadata['connectivity'] = {'knowledge-source': 'sckan-test'}
+    write_annotations()
+    monkeypatch.setattr(mapserver.server.flatmap, 'query_knowledge',
+                        lambda sql, params: {'error': 'Knowledge Store not available'})
+    result = connectivity(client, paths='ilxtr:path-1').json()
+    assert result['error'] == 'Knowledge Store not available'
+    assert list(result['paths']) == ['ilxtr:path-1']
@@ -0,0 +1,54 @@
+import sqlite3
+
+import pytest
+
+import mapserver.knowledge
+from mapserver.knowledge import KNOWLEDGE_BASE, KnowledgeStorePool, UnavailableKnowledgeStore
+
+@pytest.fixture
+def closed(monkeypatch):
+    closed = []
+    close = mapserver.knowledge.KnowledgeStore.close
+    def record_close(store):
+        closed.append(store)
+        close(store)
+    monkeypatch.setattr(mapserver.knowledge.KnowledgeStore, 'close', record_close)
+    return closed
+
+def create_store(directory):
+    db = sqlite3.connect(directory / KNOWLEDGE_BASE)
+    db.execute('CREATE TABLE metadata (name TEXT, value TEXT)')
+    db.commit()
+    db.close()
+
+def test_unavailable_store(tmp_path, closed):
+    pool = KnowledgeStorePool(str(tmp_path))
+    store = pool.store()
+    assert isinstance(store, UnavailableKnowledgeStore)
+    assert store.error is not None
+    assert store.query('SELECT 1', []) == {'error': store.error}
+    assert store.knowledge_sources() == []
+    # The store that failed to open has been closed and isn't kept
+    assert len(closed) == 1
+    pool.close()
+    assert len(closed) == 1
+
+def test_store_reused(tmp_path, closed):
+    create_store(tmp_path)
+    pool = KnowledgeStorePool(str(tmp_path))
+    store = pool.store()
+    assert store.error is None
+    assert pool.store() is store
+    assert store.query('SELECT 1', [])['values'] == [(1,)]
+    assert closed == []
+    pool.close()
+    assert closed == [store]
+
+def test_store_retried(tmp_path, closed):
+    pool = KnowledgeStorePool(str(tmp_path))
+    assert pool.store().error is not None
+    create_store(tmp_path)
+    store = pool.store()
+    assert store.error is None
+    assert pool.store() is store
+    pool.close()
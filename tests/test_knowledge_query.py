@@ -0,0 +1,44 @@
+import pytest
+
+from mapserver.knowledge import KnowledgeStore
+
+COUNT_TO_TEN = 'WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x+1 FROM n WHERE x<10) SELECT x FROM n'
+COUNT_FOREVER = 'WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x+1 FROM n) SELECT max(x) FROM n'
+
+@pytest.fixture
+def store(tmp_path):
+    store = KnowledgeStore(str(tmp_path), create=True, update=True)
+    assert store.error is None
+    yield store
+    store.close()
+
+def test_all_rows(store):
+    result = store.query(COUNT_TO_TEN, [])
+    assert result['keys'] == ('x',)
+    assert [row[0] for row in result['values']] == list(range(1, 11))
+    assert 'truncated' not in result
+
+def test_truncated(store):
+    result = store.query(COUNT_TO_TEN, [], max_rows=3)
+    assert [row[0] for row in result['values']] == [1, 2, 3]
+    assert result['truncated'] is True
+
+@pytest.mark.parametrize('max_rows', [10, 11])
+def test_not_truncated(store, max_rows):
+    result = store.query(COUNT_TO_TEN, [], max_rows=max_rows)
+    assert len(result['values']) == 10
+    assert 'truncated' not in result
+
+def test_time_limit(store):
+    result = store.query(COUNT_FOREVER, [], time_limit=0.1)
+    assert result == {'error': 'Query exceeded its time limit of 0.1 seconds'}
+    # The connection can still be used after a query has been stopped
+    assert 'error' not in store.query(COUNT_TO_TEN, [], time_limit=0.1)
+
+def test_within_time_limit(store):
+    result = store.query(COUNT_TO_TEN, [], time_limit=10)
+    assert len(result['values']) == 10
+
+def test_query_error(store):
+    result = store.query('SELECT * FROM missing_table', [], time_limit=10)
+    assert 'no such table' in result['error']
@@ -0,0 +1,62 @@
+import json
+import sqlite3
+
+import pytest
+from litestar import Litestar
+from litestar.testing import TestClient
+
+import mapserver.server.knowledge
+from mapserver.knowledge import KnowledgeStorePool
+from mapserver.server.knowledge import NDJSON_MEDIA_TYPE, knowledge_query
+
+ROWS = [(1, 'one', '{"n": 1}'), (2, 'two', '{"n": 2}'), (3, 'three', '{"n": 3}'), (4, 'four', 'not json')]
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    db = sqlite3.connect(tmp_path / 'knowledgebase.db')
+    db.execute('CREATE TABLE numbers (n INTEGER, name TEXT, data TEXT, image BLOB)')
+    db.executemany('INSERT INTO numbers VALUES (?, ?, ?, NULL)', ROWS)
+    db.commit()
+    db.close()
+    monkeypatch.setattr(mapserver.server.knowledge, 'knowledge_stores', KnowledgeStorePool(str(tmp_path)))
+    monkeypatch.setattr(mapserver.server.knowledge, 'QUERY_STREAM_BATCH_SIZE', 2)
+    with TestClient(app=Litestar(route_handlers=[knowledge_query])) as client:
+        yield client
+
+def stream_query(client, sql, params=None):
+    response = client.post('/query/', json={'sql': sql, 'params': params or []},
+                           headers={'Accept': NDJSON_MEDIA_TYPE})
+    assert response.status_code == 201
+    assert response.headers.get_list('content-type') == [NDJSON_MEDIA_TYPE]
+    assert response.text.endswith('\n')
+    return [json.loads(line) for line in response.text.splitlines()]
+
+def test_stream(client):
+    lines = stream_query(client, 'SELECT n, name FROM numbers WHERE name<>? ORDER BY n', ['one'])
+    assert lines == [{'keys': ['n', 'name']}, [2, 'two'], [3, 'three'], [4, 'four']]
+
+def test_stream_empty(client):
+    assert stream_query(client, 'SELECT n FROM numbers WHERE n>10') == [{'keys': ['n']}]
+
+def test_stream_null_blob(client):
+    assert stream_query(client, 'SELECT image FROM numbers WHERE n=1') == [{'keys': ['image']}, [None]]
+
+def test_stream_error(client):
+    lines = stream_query(client, 'SELECT * FROM missing')
+    assert len(lines) == 1
+    assert 'no such table' in lines[0]['error']
+
+def test_stream_error_after_rows(client):
+    # The last row's data isn't JSON, so reading the second batch fails
+    lines = stream_query(client, 'SELECT n, json_extract(data, "$.n") FROM numbers')
+    assert lines[0] == {'keys': ['n', 'json_extract(data, "$.n")']}
+    assert lines[1:3] == [[1, 1], [2, 2]]
+    assert len(lines) == 4
+    assert 'error' in lines[3]
+
+def test_json_not_streamed(client, monkeypatch):
+    monkeypatch.setattr(mapserver.server.knowledge, 'query_knowledge',
+                        lambda sql, params: {'keys': ['n'], 'values': [[1]]})
+    response = client.post('/query/', json={'sql': 'SELECT 1 AS n'}, headers={'Accept': 'application/json'})
+    assert response.headers['content-type'] == 'application/json'
+    assert response.json() == {'keys': ['n'], 'values': [[1]]}
@@ -0,0 +1,28 @@
+import pytest
+
+from mapserver.knowledge import normalised_sql
+
+@pytest.mark.parametrize(('sql', 'normalised'), [
+    ('select 1', 'select 1'),
+    ('  select\n\t*   from   t  ', 'select * from t'),
+    ('select 1 -- a comment\n  , 2', 'select 1 , 2'),
+    ('select 1 -- a comment , 2', 'select 1'),
+    ('select /* a\n comment */ 1', 'select 1'),
+    ('select 1 /* unterminated', 'select 1'),
+    ('select/**/1', 'select 1'),
+    ("select 'a  b'", "select 'a  b'"),
+    ("select 'it''s  a  string'", "select 'it''s  a  string'"),
+    ('select "a  column"', 'select "a  column"'),
+    ("select 'it''s  -- not a comment'", "select 'it''s  -- not a comment'"),
+    ('select "a  column" from [a  table]', 'select "a  column" from [a  table]'),
+    ('select `/* kept */`', 'select `/* kept */`'),
+    ("where x = 'a'  and y = 'b'", "where x = 'a' and y = 'b'"),
+])
+def test_normalised_sql(sql, normalised):
+    assert normalised_sql(sql) == normalised
+
+def test_same_statement():
+    assert (normalised_sql('SELECT path_id\n  FROM path_features -- all paths\n WHERE feature_id=?')
+         == normalised_sql('SELECT path_id FROM path_features WHERE feature_id=?'))
+    assert (normalised_sql('SELECT path_id\n  FROM path_features\n WHERE feature_id=?')
+         == normalised_sql('SELECT path_id FROM path_features WHERE feature_id=?'))
@@ -0,0 +1,112 @@
+import gzip
+import struct
+
+import pytest
+
+from mapserver.pmtiles import (PMTILES_COMPRESSION_GZIP, PMTILES_COMPRESSION_NONE, PMTILES_HEADER_SIZE,
+                               PMTILES_MAGIC, PMTILES_VERSION, PMTilesHeader, TileIndex, zxy_to_tile_id)
+
+def varint(value: int) -> bytes:
+    data = bytearray()
+    while value >= 0x80:
+        data.append((value & 0x7F) | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+def directory(entries: list[tuple[int, int, int, int]]) -> bytes:
+    """
+    Encode (tile_id, offset, length, run_length) entries as a PMTiles directory.
+    """
+    data = varint(len(entries))
+    last_id = 0
+    for (tile_id, _, _, _) in entries:
+        data += varint(tile_id - last_id)
+        last_id = tile_id
+    data += b''.join(varint(entry[3]) for entry in entries)
+    data += b''.join(varint(entry[2]) for entry in entries)
+    for (n, (_, offset, length, _)) in enumerate(entries):
+        if n > 0 and offset == entries[n-1][1] + entries[n-1][2]:
+            data += varint(0)
+        else:
+            data += varint(offset + 1)
+    return data
+
+def compress(data: bytes, compression: int) -> bytes:
+    return gzip.compress(data) if compression == PMTILES_COMPRESSION_GZIP else data
+
+def archive(root: bytes, leaves: bytes, compression: int) -> tuple[bytes, PMTilesHeader]:
+    """
+    An archive with compressed directories, without any tile data.
+    """
+    root_offset = PMTILES_HEADER_SIZE
+    leaf_offset = root_offset + len(root)
+    tile_data_offset = leaf_offset + len(leaves)
+    header = bytearray(PMTILES_HEADER_SIZE)
+    header[0:7] = PMTILES_MAGIC
+    header[7] = PMTILES_VERSION
+    struct.pack_into('<8Q', header, 8, root_offset, len(root), 0, 0,
+                                       leaf_offset, len(leaves), tile_data_offset, 1000)
+    struct.pack_into('<5B', header, 97, compression, PMTILES_COMPRESSION_GZIP, 1, 0, 3)
+    data = bytes(header) + root + leaves
+    return (data, PMTilesHeader.from_bytes(data))
+
+def test_zxy_to_tile_id():
+    assert zxy_to_tile_id(0, 0, 0) == 0
+    assert [zxy_to_tile_id(1, x, y) for (x, y) in ((0, 0), (0, 1), (1, 1), (1, 0))] == [1, 2, 3, 4]
+    assert zxy_to_tile_id(2, 0, 0) == 5
+    assert zxy_to_tile_id(3, 0, 0) == 21
+    assert zxy_to_tile_id(3, 7, 0) == 84
+
+def test_tile_ids_unique():
+    tile_ids = {zxy_to_tile_id(z, x, y) for z in range(5) for x in range(1 << z) for y in range(1 << z)}
+    assert tile_ids == set(range(((1 << 10) - 1)//3))
+
+@pytest.mark.parametrize('zxy', [(1, 2, 0), (1, 0, 2), (2, -1, 0), (32, 0, 0)])
+def test_zxy_out_of_range(zxy):
+    with pytest.raises(ValueError):
+        zxy_to_tile_id(*zxy)
+
+def test_header():
+    (_, header) = archive(directory([]), b'', PMTILES_COMPRESSION_NONE)
+    assert header.root_offset == PMTILES_HEADER_SIZE
+    assert header.internal_compression == PMTILES_COMPRESSION_NONE
+    assert header.tile_compression == PMTILES_COMPRESSION_GZIP
+    assert (header.min_zoom, header.max_zoom) == (0, 3)
+
+def test_unsupported_header():
+    (data, _) = archive(directory([]), b'', PMTILES_COMPRESSION_NONE)
+    with pytest.raises(IOError):
+        PMTilesHeader.from_bytes(data[:PMTILES_HEADER_SIZE-1])
+    with pytest.raises(IOError):
+        PMTilesHeader.from_bytes(b'XMTiles' + data[7:])
+    with pytest.raises(IOError):
+        PMTilesHeader.from_bytes(data[:7] + bytes([2]) + data[8:])
+
+@pytest.mark.parametrize('compression', [PMTILES_COMPRESSION_NONE, PMTILES_COMPRESSION_GZIP])
+def test_directory_decode(compression):
+    # Tiles 0 to 4 are in the root, with tiles 1 and 2 sharing data, and
+    # tiles 5 onwards are in two leaf directories
+    leaf_1 = compress(directory([(5, 300, 10, 1), (6, 310, 20, 1)]), compression)
+    leaf_2 = compress(directory([(21, 400, 5, 1), (84, 500, 7, 1)]), compression)
+    root = compress(directory([(0, 0, 100, 1), (1, 100, 50, 2), (3, 150, 25, 1), (4, 200, 30, 1),
+                               (5, 0, len(leaf_1), 0), (21, len(leaf_1), len(leaf_2), 0)]), compression)
+    (data, header) = archive(root, leaf_1 + leaf_2, compression)
+    index = TileIndex(data, header)
+    tile_data = header.tile_data_offset
+    assert len(index) == 8
+    assert index.find(0) == (tile_data, 100)
+    assert index.find(1) == (tile_data + 100, 50)
+    assert index.find(2) == (tile_data + 100, 50)
+    assert index.find(3) == (tile_data + 150, 25)
+    assert index.find(4) == (tile_data + 200, 30)
+    assert index.find(6) == (tile_data + 310, 20)
+    assert index.find(21) == (tile_data + 400, 5)
+    assert index.find(84) == (tile_data + 500, 7)
+    assert index.find(7) is None
+    assert index.find(85) is None
+
+def test_unsupported_compression():
+    (data, header) = archive(directory([]), b'', 3)
+    with pytest.raises(IOError):
+        TileIndex(data, header)
@@ -0,0 +1,66 @@
+import sqlite3
+
+import pytest
+
+import mapserver.tiles
+from mapserver.tiles import TileIndex
+
+# Tiles as (z, x, y) with y numbered from the top
+TILES = [(0, 0, 0), (2, 1, 0), (2, 2, 3), (2, 3, 1), (5, 10, 20), (5, 11, 20), (5, 12, 25)]
+
+SIGNATURE = (1700000000000000000, 123456)
+
+@pytest.fixture
+def tile_db():
+    db = sqlite3.connect(':memory:')
+    db.execute('CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)')
+    db.executemany('INSERT INTO tiles VALUES (?, ?, ?, ?)',
+                   [(z, x, (1 << z) - 1 - y, b'') for (z, x, y) in TILES])
+    yield db
+    db.close()
+
+def all_tiles(index: TileIndex, zooms=range(7)) -> set[tuple[int, int, int]]:
+    return {(z, x, y) for z in zooms for x in range(1 << z) for y in range(1 << z)
+                        if index.exists(z, x, y)}
+
+def test_build(tile_db):
+    index = TileIndex.build(tile_db)
+    assert all_tiles(index) == set(TILES)
+    assert index.exists(1, 0, 0) is False
+    assert index.exists(5, 100, 100) is False
+
+def test_save_and_load(tile_db, tmp_path):
+    path = tmp_path / 'index.tileindex'
+    TileIndex.build(tile_db).save(path, SIGNATURE)
+    index = TileIndex.load(path, SIGNATURE)
+    assert index is not None
+    assert all_tiles(index) == set(TILES)
+
+def test_load_stale(tile_db, tmp_path):
+    path = tmp_path / 'index.tileindex'
+    TileIndex.build(tile_db).save(path, SIGNATURE)
+    assert TileIndex.load(path, (SIGNATURE[0] + 1, SIGNATURE[1])) is None
+    assert TileIndex.load(path, (SIGNATURE[0], SIGNATURE[1] + 1)) is None
+
+def test_load_invalid(tile_db, tmp_path):
+    path = tmp_path / 'index.tileindex'
+    assert TileIndex.load(path, SIGNATURE) is None
+    TileIndex.build(tile_db).save(path, SIGNATURE)
+    data = path.read_bytes()
+    path.write_bytes(data[:-1])
+    assert TileIndex.load(path, SIGNATURE) is None
+    path.write_bytes(data + b'\0')
+    assert TileIndex.load(path, SIGNATURE) is None
+    path.write_bytes(b'X' + data[1:])
+    assert TileIndex.load(path, SIGNATURE) is None
+
+def test_unindexed_zoom(tile_db, tmp_path, monkeypatch):
+    # Zoom 5's tiles cover a 3 by 6 area, too large to index
+    monkeypatch.setattr(mapserver.tiles, 'MAX_TILE_INDEX_BITS', 16)
+    path = tmp_path / 'index.tileindex'
+    TileIndex.build(tile_db).save(path, SIGNATURE)
+    index = TileIndex.load(path, SIGNATURE)
+    assert index is not None
+    assert index.exists(5, 10, 20) is None
+    assert index.exists(5, 0, 0) is None
+    assert all_tiles(index, range(5)) == {tile for tile in TILES if tile[0] < 5}
@@ -89,7 +89,7 @@ is that maps persist once they are published.
 def flatmaps_in_directory(directory: Path, taxon: Optional[str]=None) -> list[dict]:
 #===================================================================================
     settings['FLATMAP_ROOT'] = str(directory)
-    flatmaps = get_flatmap_list()
+    flatmaps = get_flatmap_list(persistent=False)
     filtered_maps = []
     for flatmap in flatmaps:
         if flatmap.get('taxon', '') == '':
@@ -62,7 +62,9 @@ def get_map_list(endpoint, **kwds):
 
 
 def latest_maps(endpoint):
-    maps = get_map_list(endpoint)
+    # Servers that don't filter their map list return all maps, so we still
+    # find the latest ourselves
+    maps = get_map_list(endpoint, params={'latest': 'true'})
     if len(maps) and (error := maps[0].get('error')) is not None:
         raise IOError(f'{endpoint}: {error}')
     latest_maps = {}
@@ -110,7 +110,7 @@ confirm their actual promotion.
 def flatmaps_in_directory(directory: Path, map_style: str, taxon: Optional[str]=None, sex: Optional[str]=None) -> list[dict]:
 #============================================================================================================================
     settings['FLATMAP_ROOT'] = str(directory)
-    flatmaps = get_flatmap_list()
+    flatmaps = get_flatmap_list(persistent=False)
     filtered_maps = []
     for flatmap in flatmaps:
         if flatmap.get('uuid') is None: